@@ -10,11 +10,11 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import errno
 import logging
 import os
 import signal
 
-from fnmatch import fnmatch
 from os.path import join
 
 from . import pidutil
@@ -34,7 +34,9 @@ except ImportError:
 
 class DcRPM:
     YUM_PATH = "/var/lib/yum"  # type: str
-    YUM_TRANSACTION_BASE = "*transaction-all.*"  # type: str
+    # Equivalent to the glob "*transaction-all.*": with wildcards on both ends
+    # it's just a substring test.
+    YUM_TRANSACTION_BASE = "transaction-all."  # type: str
 
     def __init__(self, rpmutil, args):
         # type: (RPMUtil, argparse.Namespace) -> None
@@ -45,129 +47,131 @@ class DcRPM:
 
     def run(self):
         # type: () -> bool
+        # Bind frequently used attributes to locals for the pass loop below.
+        logger = self.logger
+        status_logger = self.status_logger
+        rpmutil = self.rpmutil
+        args = self.args
+
         if not self.has_free_disk_space():
-            self.status_logger.error("not_enough_disk")
-            self.logger.error("Need at least %sB free to continue" % self.args.minspace)
+            status_logger.error("not_enough_disk")
+            logger.error("Need at least %sB free to continue" % args.minspace)
             return False
 
         # Check old yum transactions.
-        if self.args.clean_yum_transactions and self.stale_yum_transactions_exist():
-            self.logger.info("Cleaning old yum transaction")
-            self.rpmutil.clean_yum_transactions()
+        if args.clean_yum_transactions and self.stale_yum_transactions_exist():
+            logger.info("Cleaning old yum transaction")
+            rpmutil.clean_yum_transactions()
 
         # Check stuck yum.
-        if self.args.check_stuck_yum:
-            result = Yum().check_stuck(dry_run=self.args.dry_run)
+        if args.check_stuck_yum:
+            result = Yum().check_stuck(dry_run=args.dry_run)
             if not result:
-                self.logger.error("Failed to unstuck yum processes")
+                logger.error("Failed to unstuck yum processes")
 
         # Detect database backend
-        backend = self.rpmutil.get_db_backend()
+        backend = rpmutil.get_db_backend()
 
         # Start main checks.
-        for i in range(self.args.max_passes):
-            self.logger.debug("Running pass: %d", i)
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        for i in range(args.max_passes):
+            if debug_enabled:
+                logger.debug("Running pass: %d", i)
 
             try:
                 # Optional forensic data collection
-                if self.args.forensic:
+                if args.forensic:
                     if backend == "bdb":
-                        self.logger.info(
-                            "Running forensic data collection (db_stat -CA)"
-                        )
-                        self.rpmutil.db_stat()
+                        logger.info("Running forensic data collection (db_stat -CA)")
+                        rpmutil.db_stat()
                     else:
-                        self.logger.warning(
+                        logger.warning(
                             "Forensics data collection is not supported on %s" % backend
                         )
 
                 # Kill any straggler rpm query processes
-                self.logger.info("Searching for spinning rpm query processes")
-                self.rpmutil.kill_spinning_rpm_query_processes()
+                logger.info("Searching for spinning rpm query processes")
+                rpmutil.kill_spinning_rpm_query_processes()
 
                 # Exercise single indexes
-                self.logger.info("Sanity checking rpmdb indexes")
-                self.rpmutil.check_rpmdb_indexes()
-                self.logger.info("Rpmdb indexes OK")
+                logger.info("Sanity checking rpmdb indexes")
+                rpmutil.check_rpmdb_indexes()
+                logger.info("Rpmdb indexes OK")
 
                 # Black box check - does rpm -qa even work?
-                self.logger.info("Running black box check (rpm -qa)")
-                self.rpmutil.check_rpm_qa()
-                self.logger.info("Black box check OK")
+                logger.info("Running black box check (rpm -qa)")
+                rpmutil.check_rpm_qa()
+                logger.info("Black box check OK")
 
-                if self.args.dbpath == "/var/lib/rpm":
-                    if self.args.run_yum_check:
-                        self.logger.info("Running yum check")
+                if args.dbpath == "/var/lib/rpm":
+                    if args.run_yum_check:
+                        logger.info("Running yum check")
                         Yum().run_yum_check()
-                        self.logger.info("Yum check ok")
+                        logger.info("Yum check ok")
 
-                    if self.args.run_yum_clean and not self.args.run_yum_check:
-                        self.logger.info("Running yum clean expire-cache")
+                    if args.run_yum_clean and not args.run_yum_check:
+                        logger.info("Running yum clean expire-cache")
                         Yum().run_yum_clean()
-                        self.logger.info("Yum clean ok")
+                        logger.info("Yum clean ok")
 
                 else:
-                    self.logger.info(
+                    logger.info(
                         "Skipping yum sanity checks because "
                         "custom dbpath has been provided"
                     )
 
-                self.logger.info("Running silent corruption check (rpm -q)")
-                self.rpmutil.query("coreutils")
-                self.logger.info("Silent corruption check OK")
+                logger.info("Running silent corruption check (rpm -q)")
+                rpmutil.query("coreutils")
+                logger.info("Silent corruption check OK")
 
                 # Check tables (mismatch for -qa vs. -q).
-                self.logger.info(
-                    "Running table checks (attempting to query each package)"
-                )
-                self.rpmutil.check_tables()
-                self.logger.info("Table checks OK")
+                logger.info("Running table checks (attempting to query each package)")
+                rpmutil.check_tables()
+                logger.info("Table checks OK")
 
                 # Verify tables (db_verify for each file).
                 if backend == "bdb":
-                    self.logger.info("Verifying each table in %s", self.args.dbpath)
+                    logger.info("Verifying each table in %s", args.dbpath)
                     if not self.call_verify_tables():
                         continue
                 else:
-                    self.logger.warning(
+                    logger.warning(
                         "Table verification is not implemented for %s" % backend
                     )
 
             # Need to run db_recover.
             except DBNeedsRecovery:
-                self.logger.error("DB needs recovery")
+                logger.error("DB needs recovery")
                 try:
                     if backend == "bdb":
                         self.run_recovery()
                     else:
-                        self.logger.warning(
-                            "Recovery is not implemented for %s" % backend
-                        )
-                    self.rpmutil.check_rpmdb_indexes()
+                        logger.warning("Recovery is not implemented for %s" % backend)
+                    rpmutil.check_rpmdb_indexes()
                     continue
                 except (DBNeedsRebuild, DBNeedsRecovery):
-                    self.logger.error("DB needs rebuild")
+                    logger.error("DB needs rebuild")
                     self.run_rebuild()
                     continue
 
             # Need to run rpm --rebuilddb.
             except DBNeedsRebuild:
-                self.logger.error("DB needs rebuild")
+                logger.error("DB needs rebuild")
                 self.run_rebuild()
                 continue
 
             # Everything else.
             except DcRPMException as e:
-                self.logger.warning("Got other exception: %s", e)
+                logger.warning("Got other exception: %s", e)
                 continue
 
             # All's well - return early!
-            self.logger.info("Ran a pass without detecting any problems. Exiting.")
+            logger.info("Ran a pass without detecting any problems. Exiting.")
             return True
 
         # Ran out of attempts.
-        self.status_logger.error("")
-        self.logger.error("Unable to repair RPM database")
+        status_logger.error("")
+        logger.error("Unable to repair RPM database")
         return False
 
     def run_recovery(self):
@@ -192,8 +196,7 @@ class DcRPM:
         self.logger.info("Attempting to fix RPM DB at %s", self.args.dbpath)
         dbenv_lockfile = join(self.args.dbpath, ".dbenv.lock")
         rpm_lockfile = join(self.args.dbpath, ".rpm.lock")
-        lock_procs = pidutil.procs_holding_file(dbenv_lockfile)
-        lock_procs |= pidutil.procs_holding_file(rpm_lockfile)
+        lock_procs = pidutil.procs_holding_files([dbenv_lockfile, rpm_lockfile])
 
         self.logger.debug("Found %d pids holding lock files", len(lock_procs))
         if lock_procs and pidutil.send_signals(lock_procs, signal.SIGKILL):
@@ -230,15 +233,15 @@ class DcRPM:
         old_path = join(self.args.dbpath, "__db.001")
         new_path = join(self.args.dbpath, "__dcrpm_py_inode_pointer")
 
-        # Make sure it doesn't exist.
+        # Save it, replacing a pointer left behind by an earlier run if needed.
         try:
-            os.unlink(new_path)
-        except OSError:
-            pass
-
-        # Then save it.
-        try:
-            os.link(old_path, new_path)
+            try:
+                os.link(old_path, new_path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                os.unlink(new_path)
+                os.link(old_path, new_path)
             return new_path
         except OSError:
             self.status_logger.warning("link_failed")
@@ -249,10 +252,8 @@ class DcRPM:
         """
         Detects whether there are stale yum transactions in /var/lib/yum.
         """
-        return any(
-            fnmatch(str(f), self.YUM_TRANSACTION_BASE)
-            for f in os.listdir(self.YUM_PATH)
-        )
+        base = self.YUM_TRANSACTION_BASE
+        return any(base in f for f in os.listdir(self.YUM_PATH))
 
     def has_free_disk_space(self):
         # type: () -> bool
@@ -261,8 +262,7 @@ class DcRPM:
         checks.
         """
         buf = os.statvfs(self.args.dbpath)
-        desired_free_blocks = self.args.minspace // buf.f_bsize
-        return buf.f_bfree > desired_free_blocks
+        return buf.f_bfree * buf.f_bsize > self.args.minspace
 
     def call_verify_tables(self):
         # type: () -> bool
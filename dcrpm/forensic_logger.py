@@ -19,8 +19,6 @@ try:
 except ImportError:
     pass
 
-from datetime import datetime
-
 
 class ForensicLogger(logging.Handler):
     """
@@ -41,18 +39,28 @@ class ForensicLogger(logging.Handler):
         if not hasattr(record, "key"):
             return
 
-        with open(
-            os.path.join(
-                self.logdir,
-                "{}.{}.txt".format(
-                    # pyre-ignore[16]: 'key' gets inserted dynamically by logger.debug.
-                    record.key,
-                    datetime.fromtimestamp(time.time()).strftime("%Y%m%d%H%M%S"),
-                ),
+        path = os.path.join(
+            self.logdir,
+            "{}.{}.txt".format(
+                # pyre-ignore[16]: 'key' gets inserted dynamically by logger.debug.
+                record.key,
+                time.strftime("%Y%m%d%H%M%S", time.localtime(record.created)),
             ),
-            "w",
-        ) as fp:
-            fp.write(record.msg)
+        )
+        data = record.msg
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+
+        # Unbuffered writes; no need for the file object machinery. os.write can
+        # write less than asked (e.g. interrupted, or a disk filling up), so keep
+        # going until everything is out.
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view) :]
+        finally:
+            os.close(fd)
 
     def emit(self, record):
         # type: (logging.LogRecord) -> None
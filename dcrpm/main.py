@@ -32,6 +32,14 @@ DEFAULT_MAX_PASSES = 5  # type: int
 # Taken from the original C++ dcrpm
 DEFAULT_MIN_REQUIRED_FREE_SPACE = 150 * 1048576  # type: int
 
+# Path arguments that default to looking up the given command in $PATH.
+TOOL_PATH_DEFAULTS = (
+    ("rpm_path", "rpm"),
+    ("recover_path", "db_recover"),
+    ("verify_path", "db_verify"),
+    ("stat_path", "db_stat"),
+)  # type: t.Tuple[t.Tuple[str, str], ...]
+
 LOG_FORMAT = (
     "%(asctime)s %(levelname)s [%(module)s.%(funcName)s]: %(message)s"
 )  # type: str
@@ -83,22 +91,28 @@ def parse_args():
         help="Run stuck yum check and remediation",
     )
     parser.add_argument(
-        "--rpm-path", metavar="PATH", default=which("rpm"), help="Path to rpm"
+        "--rpm-path",
+        metavar="PATH",
+        default=argparse.SUPPRESS,
+        help="Path to rpm (default: found in $PATH)",
     )
     parser.add_argument(
         "--recover-path",
         metavar="PATH",
-        default=which("db_recover"),
-        help="Path to db_recover",
+        default=argparse.SUPPRESS,
+        help="Path to db_recover (default: found in $PATH)",
     )
     parser.add_argument(
         "--verify-path",
         metavar="PATH",
-        default=which("db_verify"),
-        help="Path to db_verify",
+        default=argparse.SUPPRESS,
+        help="Path to db_verify (default: found in $PATH)",
     )
     parser.add_argument(
-        "--stat-path", metavar="PATH", default=which("db_stat"), help="Path to db_stat"
+        "--stat-path",
+        metavar="PATH",
+        default=argparse.SUPPRESS,
+        help="Path to db_stat (default: found in $PATH)",
     )
     parser.add_argument(
         "--clean-yum-transactions",
@@ -157,7 +171,14 @@ def parse_args():
         default=["Filedigests", "Obsoletename", "Provideversion"],
         help="Databases to blacklist from db_verify",
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    # Only search $PATH for tools that weren't given explicitly, and not at all
+    # for --help/--version (argparse exits before we get here).
+    for attr, cmd in TOOL_PATH_DEFAULTS:
+        if not hasattr(args, attr):
+            setattr(args, attr, which(cmd))
+    return args
 
 
 def main():
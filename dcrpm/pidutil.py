@@ -12,10 +12,20 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import logging
 import os
+import signal
+import time
 
 import psutil
 
-from .util import DcRPMException, StatusCode, TimeoutExpired, run_with_timeout, which
+from .util import (
+    DcRPMException,
+    StatusCode,
+    TimeoutExpired,
+    memoize,
+    run_with_timeout,
+    wait_pidfd,
+    which,
+)
 
 try:
     import typing as t
@@ -31,6 +41,7 @@ DEFAULT_TIMEOUT = 5  # type: int
 LSOF_TIMEOUT = 60  # type: int
 # Don't kill init/launchd or kernel_task
 MIN_PID = 2  # type: int
+PROC_PATH = "/proc"  # type: str
 
 logger = logging.getLogger()  # type: logging.Logger
 
@@ -48,11 +59,14 @@ def process(pid):
         return None
 
 
-def _pids_holding_file(lsof, path):
-    # type: (str, str) -> t.Set[int]
+def _pids_holding_files(lsof, paths):
+    # type: (str, t.Sequence[str]) -> t.Set[int]
     try:
+        # -l/-n/-P skip the uid, hostname and port lookups; we only want pids.
         proc = run_with_timeout(
-            [lsof, "-F", "p", path], LSOF_TIMEOUT, raise_on_nonzero=False
+            [lsof, "-l", "-n", "-P", "-F", "p"] + list(paths),
+            LSOF_TIMEOUT,
+            raise_on_nonzero=False,
         )
     except DcRPMException:
         logger.warning("lsof timed out")
@@ -62,24 +76,115 @@ def _pids_holding_file(lsof, path):
         # `lsof` has pretty coarse error reporting. Returning nonzero means either
         # nothing matched or something went wrong. If nothing matches stderr will
         # be empty; if it contains output then assume something went wrong (though
-        # "wrong" could be a fairly benign warning, like `path` not existing).
+        # "wrong" could be a fairly benign warning, like a path not existing).
         logger.warning("lsof returned non-zero: %s", proc.stderr)
 
     return {int(line[1:]) for line in proc.stdout.splitlines() if line.startswith("p")}
 
 
+@memoize
+def _has_procfs():
+    # type: () -> bool
+    return os.path.isdir(os.path.join(PROC_PATH, "self", "fd"))
+
+
+def _fds_hold(fd_path, targets):
+    # type: (str, t.Set[t.Tuple[int, int]]) -> bool
+    try:
+        fds = os.listdir(fd_path)
+    except OSError:
+        # Either the process went away or we aren't allowed to look.
+        return False
+    for fd in fds:
+        try:
+            fd_st = os.stat(os.path.join(fd_path, fd))
+        except OSError:
+            continue
+        if (fd_st.st_dev, fd_st.st_ino) in targets:
+            return True
+    return False
+
+
+def _maps_hold(maps_path, targets):
+    # type: (str, t.Set[t.Tuple[int, int, int]]) -> bool
+    try:
+        with open(maps_path) as f:
+            for line in f:
+                # address perms offset dev inode [pathname]; dev is hex MM:mm.
+                fields = line.split(None, 5)
+                if len(fields) < 5 or fields[4] == "0":
+                    continue
+                major, _, minor = fields[3].partition(":")
+                if (int(major, 16), int(minor, 16), int(fields[4])) in targets:
+                    return True
+    except (IOError, OSError):
+        pass
+    return False
+
+
+def _pids_holding_files_procfs(paths):
+    # type: (t.Iterable[str]) -> t.Set[int]
+    """
+    Walks /proc once and returns the pids with an fd open on, or a mapping of,
+    the same inode as any of `paths`. Comparing (st_dev, st_ino) rather than
+    link targets means other links to the same inode are found too, same as
+    with `lsof`. Mappings matter because Berkeley DB mmaps its __db.00x region
+    files, and a process can keep those mapped after closing the fd.
+    """
+    targets = set()  # type: t.Set[t.Tuple[int, int]]
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            logger.warning("Could not stat %s", path)
+            continue
+        targets.add((st.st_dev, st.st_ino))
+    if not targets:
+        return set()
+    mapped = {
+        (os.major(dev), os.minor(dev), ino) for dev, ino in targets
+    }  # type: t.Set[t.Tuple[int, int, int]]
+
+    pids = set()  # type: t.Set[int]
+    for pid in os.listdir(PROC_PATH):
+        if not pid.isdigit():
+            continue
+        pid_path = os.path.join(PROC_PATH, pid)
+        if _fds_hold(os.path.join(pid_path, "fd"), targets) or _maps_hold(
+            os.path.join(pid_path, "maps"), mapped
+        ):
+            pids.add(int(pid))
+
+    return pids
+
+
+def procs_holding_files(paths):
+    # type: (t.Sequence[str]) -> t.Set[psutil.Process]
+    """
+    Return a set of processes holding any of `paths` open or mapped. On Linux
+    this inspects /proc/<pid>/fd and /proc/<pid>/maps directly; elsewhere it
+    falls back to `lsof`. Either way all paths are looked up in a single pass,
+    and processes that have other links to the same inode open are found too.
+    """
+    if _has_procfs():
+        pids = _pids_holding_files_procfs(paths)
+    else:
+        lsof = which("lsof")
+        if lsof is None:
+            raise DcRPMException("Couldn't find `lsof` binary")
+        pids = _pids_holding_files(lsof, paths)
+
+    # pids are already unique; psutil hashes a Process by the (pid, create_time)
+    # it read on construction, so building the set costs no extra /proc reads.
+    return {proc for proc in map(process, pids) if proc is not None}
+
+
 def procs_holding_file(path):
     # type: (str) -> t.Set[psutil.Process]
     """
-    Return a set of processes holding `path` open by using `lsof`. `lsof` is slower but
-    will find processes that have other links to the same inode open.
+    Return a set of processes holding `path` open.
     """
-    lsof = which("lsof")
-    if lsof is None:
-        raise DcRPMException("Couldn't find `lsof` binary")
-
-    procs = [process(pid) for pid in _pids_holding_file(lsof, path)]
-    return set(filter(None, procs))
+    return procs_holding_files([path])
 
 
 def pidfile_info(pidfile):
@@ -92,21 +197,21 @@ def pidfile_info(pidfile):
     """
     with open(pidfile) as f:
         pid = int(f.read())
-    if pid <= 1:
-        # Negative PIDs lead to sadness
-        # https://rachelbythebay.com/w/2014/08/19/fork/
-        logger.error("Rejecting crazy pid value")
-        raise ValueError("Invalid pid value")
-    mtime = int(os.stat(pidfile).st_mtime)
+        if pid <= 1:
+            # Negative PIDs lead to sadness
+            # https://rachelbythebay.com/w/2014/08/19/fork/
+            logger.error("Rejecting crazy pid value")
+            raise ValueError("Invalid pid value")
+        # fstat the file we read rather than whatever is at the path now
+        mtime = int(os.fstat(f.fileno()).st_mtime)
     return (pid, mtime)
 
 
-def send_signal(proc, sig, timeout=DEFAULT_TIMEOUT):
-    # type: (psutil.Process, enum.IntEnum, int) -> bool
+def _deliver_signal(proc, sig):
+    # type: (psutil.Process, enum.IntEnum) -> bool
     """
-    Sends signal `sig` to process `proc`, waiting on each and handles timeouts
-    as well as nonexistent pids. Returns whether pid was successfully sent
-    signal.
+    Sends signal `sig` to process `proc` without waiting on it. Returns whether
+    the signal was delivered.
     """
     # Don't accidentally signal core system processes.
     pid = proc.pid
@@ -114,16 +219,57 @@ def send_signal(proc, sig, timeout=DEFAULT_TIMEOUT):
         logger.warning("Refusing to kill pid %d", pid)
         return False
 
-    signame = str(sig).split(".")[-1]
+    try:
+        signame = signal.Signals(sig).name
+    except (AttributeError, ValueError):
+        # Python 2 has no signal.Signals; also covers unknown signal numbers.
+        signame = str(sig)
     logger.info("Sending signal %s to pid %d", signame, pid)
     try:
         proc.send_signal(sig)
-        proc.wait(timeout=timeout)
     except psutil.NoSuchProcess:
         logger.debug("Pid %d does not exist", pid)
         return False
+
+    return True
+
+
+def wait_for_exit(proc, timeout=DEFAULT_TIMEOUT):
+    # type: (psutil.Process, int) -> None
+    """
+    Waits up to `timeout` seconds for `proc` to exit. Raises
+    psutil.TimeoutExpired if it doesn't, like psutil.Process.wait.
+    """
+    deadline = time.time() + timeout
+    exited = wait_pidfd(proc.pid, timeout)
+    if exited is None:
+        proc.wait(timeout=timeout)
+        return
+    # psutil has the final say (and reaps our own children), but if we already
+    # slept on the pidfd it shouldn't poll for the whole timeout again. The pidfd
+    # fires once the process is a zombie, and one that isn't our child stays in
+    # the process table until its own parent reaps it, so give that parent
+    # whatever is left of the timeout.
+    proc.wait(timeout=max(0, deadline - time.time()))
+
+
+def send_signal(proc, sig, timeout=DEFAULT_TIMEOUT):
+    # type: (psutil.Process, enum.IntEnum, int) -> bool
+    """
+    Sends signal `sig` to process `proc`, waiting on each and handles timeouts
+    as well as nonexistent pids. Returns whether pid was successfully sent
+    signal.
+    """
+    if not _deliver_signal(proc, sig):
+        return False
+
+    try:
+        wait_for_exit(proc, timeout)
+    except psutil.NoSuchProcess:
+        logger.debug("Pid %d does not exist", proc.pid)
+        return False
     except psutil.TimeoutExpired:
-        logger.debug("Timed out after %ds waiting for %d", timeout, pid)
+        logger.debug("Timed out after %ds waiting for %d", timeout, proc.pid)
         return False
 
     return True
@@ -132,8 +278,16 @@ def send_signal(proc, sig, timeout=DEFAULT_TIMEOUT):
 def send_signals(procs, signal, timeout=DEFAULT_TIMEOUT):
     # type: (t.Iterable[psutil.Process], enum.IntEnum, int) -> bool
     """
-    Sends signal to all processes in `procs`. Returns whether anything was
+    Sends signal to all processes in `procs`, then waits up to `timeout` for all
+    of them at once rather than for each in turn. Returns whether anything was
     successfully signaled.
     """
-    was_killed = [send_signal(p, signal, timeout) for p in procs]
-    return any(was_killed)
+    signaled = [p for p in procs if _deliver_signal(p, signal)]
+    if not signaled:
+        return False
+
+    gone, alive = psutil.wait_procs(signaled, timeout=timeout)
+    for proc in alive:
+        logger.debug("Timed out after %ds waiting for %d", timeout, proc.pid)
+
+    return bool(gone)
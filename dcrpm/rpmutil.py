@@ -19,7 +19,9 @@ import time
 
 import psutil
 
+from . import pidutil
 from .util import (
+    SUBPROCESS_TIMEOUTS,
     CompletedProcess,
     DBIndexNeedsRebuild,
     DBNeedsRebuild,
@@ -32,6 +34,12 @@ from .util import (
     run_with_timeout,
 )
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # python 2 without the futures backport
+    ThreadPoolExecutor = None
+
 try:
     import typing as t
 except ImportError:
@@ -42,9 +50,108 @@ except ImportError:
 RPM_CHECK_TIMEOUT_SEC = 5  # type: int
 YUM_COMPLETE_TIMEOUT_SEC = 10  # type: int
 VERIFY_TIMEOUT_SEC = 5  # type: int
+# Max db_verify processes to run at once
+VERIFY_JOBS = 8  # type: int
 RECOVER_TIMEOUT_SEC = 90  # type: int
 REBUILD_TIMEOUT_SEC = 300  # type: int
 MIN_ACCEPTABLE_PKG_COUNT = 50  # type: int
+# rpm, /bin/rpm or /usr/bin/rpm, but not e.g. rpmbuild (whose -q means quiet)
+_RPM_CMD_RE = re.compile(r"(?:/(?:usr/)?bin/)?rpm\b")  # type: t.Pattern[str]
+# One-line macro definitions in `rpm --showrc` output, e.g. "-14: _db_backend bdb".
+# Matched line by line across the whole output, so whitespace is [ \t] rather
+# than \s, which would run on into the next line.
+_MACRO_RE = re.compile(
+    r"^-\d+:[ \t]+(\w+)[ \t]+([\w \t]+)$", re.MULTILINE
+)  # type: t.Pattern[str]
+# Berkeley DB files rpm keeps under its dbpath, including ones only older or
+# newer rpm versions create
+_KNOWN_RPMDB_TABLES = frozenset(
+    (
+        "Basenames",
+        "Conflictname",
+        "Dirnames",
+        "Enhancename",
+        "Filedigests",
+        "Filetriggername",
+        "Group",
+        "Installtid",
+        "Name",
+        "Obsoletename",
+        "Packages",
+        "Providename",
+        "Provideversion",
+        "Pubkeys",
+        "Recommendname",
+        "Requirename",
+        "Requireversion",
+        "Sha1header",
+        "Sigmd5",
+        "Suggestname",
+        "Supplementname",
+        "Transfiletriggername",
+        "Triggername",
+    )
+)  # type: t.FrozenSet[str]
+
+
+# Predicates used by check_rpmdb_indexes. Each gets the CompletedProcess and
+# its stdout lines, and checks run in order so later ones may assume that
+# earlier ones passed.
+def _not_segfault(proc, lines):
+    # type: (CompletedProcess, t.List[str]) -> bool
+    return proc.returncode != StatusCode.SEGFAULT
+
+
+def _has_output(proc, lines):
+    # type: (CompletedProcess, t.List[str]) -> bool
+    return len(lines) >= 1
+
+
+def _single_line(proc, lines):
+    # type: (CompletedProcess, t.List[str]) -> bool
+    return len(lines) == 1
+
+
+def _three_lines(proc, lines):
+    # type: (CompletedProcess, t.List[str]) -> bool
+    return len(lines) == 3
+
+
+def _first_line_is_rpm(proc, lines):
+    # type: (CompletedProcess, t.List[str]) -> bool
+    return proc.stdout.startswith("rpm-")
+
+
+def _any_line_is_rpm_or_yum(proc, lines):
+    # type: (CompletedProcess, t.List[str]) -> bool
+    # Substring scans over stdout rather than a Python-level loop over lines
+    out = proc.stdout
+    return out.startswith(("rpm-", "yum-")) or "\nrpm-" in out or "\nyum-" in out
+
+
+_SINGLE_RPM_CHECKS = (
+    _not_segfault,
+    _single_line,
+    _first_line_is_rpm,
+)  # type: t.Tuple[t.Callable[[CompletedProcess, t.List[str]], bool], ...]
+
+
+# Run against the rpm query that follows deleting a bad index, to make sure
+# the Packages db itself is sound and rpm noticed (and rebuilt) the index.
+def _packages_db_opened(proc):
+    # type: (CompletedProcess) -> bool
+    return "cannot open Packages database" not in proc.stderr
+
+
+def _missing_index_reported(proc):
+    # type: (CompletedProcess) -> bool
+    return "missing index" in proc.stderr
+
+
+_POST_REBUILD_CHECKS = (
+    _packages_db_opened,
+    _missing_index_reported,
+)  # type: t.Tuple[t.Callable[[CompletedProcess], bool], ...]
 
 
 class RPMUtil:
@@ -61,7 +168,7 @@ class RPMUtil:
         stat_path,  # type: str
         yum_complete_transaction_path,  # type: str
         blacklist,  # type: t.List[str]
-        forensic,  # type:  bool
+        forensic,  # type: bool
     ):
         # type: (...) -> None
         self.dbpath = dbpath
@@ -74,6 +181,10 @@ class RPMUtil:
         self.forensic = forensic
         self.logger = logging.getLogger()  # type: logging.Logger
         self.status_logger = logging.getLogger("status")  # type: logging.Logger
+        self._rpmdb_indexes = None  # type: t.Optional[t.Dict[str, t.Any]]
+        self._rpmdb_indexes_key = None  # type: t.Optional[t.Tuple[str, str]]
+        # `rpm -qa` names from the last successful check_rpm_qa, for check_tables
+        self._qa_names = None  # type: t.Optional[str]
         self.populate_tables()
 
     def populate_tables(self):
@@ -85,8 +196,14 @@ class RPMUtil:
         function will populate self.tables using whatever the dbpath is at call
         time.
         """
+        try:
+            with os.scandir(self.dbpath) as entries:
+                names = [entry.name for entry in entries]
+        except AttributeError:
+            # No (context manager) os.scandir before python 3.6
+            names = os.listdir(self.dbpath)
         self.tables = [
-            table for table in os.listdir(self.dbpath) if str(table).istitle()
+            table for table in names if table in _KNOWN_RPMDB_TABLES
         ]  # type: t.List[str]
 
     def db_stat(self):
@@ -95,6 +212,12 @@ class RPMUtil:
         Runs `db_stat -CA` which offers a view into the state of Berkeley DB
         environment.
         """
+        # The output only goes to status_logger.debug; don't spawn db_stat just
+        # to have it dropped.
+        if not self.status_logger.isEnabledFor(logging.DEBUG):
+            self.logger.info("Skipping db_stat, status logging is above DEBUG")
+            return
+
         try:
             ds = run_with_timeout(
                 [self.stat_path, "-CA", "-h", self.dbpath],
@@ -112,39 +235,33 @@ class RPMUtil:
             self.logger.error("db_stat -CA failed")
 
     def _poke_index(self, cmd, checks):
-        # type: (t.Sequence[str], t.Iterable[t.Callable[[CompletedProcess], bool]]) -> CompletedProcess
+        # type: (t.Sequence[str], t.Iterable[t.Callable[[CompletedProcess, t.List[str]], bool]]) -> CompletedProcess
         """
-        Run cmd, and ensure all checks are True. Raise DBIndexNeedsRebuild otherwise
+        Run cmd, and ensure all checks are True. Raise DBIndexNeedsRebuild otherwise.
+        Each check gets the process and its stdout lines, split once up front.
         """
         proc = run_with_timeout(cmd, RPM_CHECK_TIMEOUT_SEC, raise_on_nonzero=False)
+        lines = proc.stdout.splitlines()
         for check in checks:
-            if not check(proc):
+            if not check(proc, lines):
                 raise DBIndexNeedsRebuild
 
         return proc
 
-    def check_rpmdb_indexes(self):
-        # type: () -> None
+    def _rpmdb_index_probes(self):
+        # type: () -> t.Dict[str, t.Optional[t.Dict[str, t.Union[t.Sequence[str], t.Sequence[t.Callable[[CompletedProcess, t.List[str]], bool]]]]]]
         """
-        For each rpmdb file we define a rpm command that blows up on inconsistencies,
-        or returns incorrect results. Structure:
-        'name_of_file': {
-            'cmd': 'str', # rpm command
-            'checks': [], # list of conditions to be met
-        }
+        Returns the index probes used by check_rpmdb_indexes. They only depend on
+        rpm_path and dbpath, so they're built once and rebuilt if either changes.
         """
-        if sys.platform == "darwin":
-            self.logger.debug("check_rpmdb_indexes is not implemented for darwin")
-            return
+        key = (self.rpm_path, self.dbpath)
+        if self._rpmdb_indexes is not None and self._rpmdb_indexes_key == key:
+            return self._rpmdb_indexes
 
         rpmdb_indexes = {
             "Basenames": {
                 "cmd": [self.rpm_path, "-qf", self.rpm_path, "--dbpath", self.dbpath],
-                "checks": [
-                    lambda proc: proc.returncode != StatusCode.SEGFAULT,
-                    lambda proc: len(proc.stdout.splitlines()) == 1,
-                    lambda proc: proc.stdout.splitlines()[0].startswith("rpm-"),
-                ],
+                "checks": _SINGLE_RPM_CHECKS,
             },
             "Conflictname": {
                 "cmd": [
@@ -155,10 +272,7 @@ class RPMUtil:
                     "--dbpath",
                     self.dbpath,
                 ],
-                "checks": [
-                    lambda proc: proc.returncode != StatusCode.SEGFAULT,
-                    lambda proc: len(proc.stdout.splitlines()) == 3,
-                ],
+                "checks": (_not_segfault, _three_lines),
             },
             "Obsoletename": {
                 "cmd": [
@@ -169,10 +283,7 @@ class RPMUtil:
                     "--dbpath",
                     self.dbpath,
                 ],
-                "checks": [
-                    lambda proc: proc.returncode != StatusCode.SEGFAULT,
-                    lambda proc: len(proc.stdout.splitlines()) >= 1,
-                ],
+                "checks": (_not_segfault, _has_output),
             },
             "Providename": {
                 "cmd": [
@@ -183,11 +294,7 @@ class RPMUtil:
                     "--dbpath",
                     self.dbpath,
                 ],
-                "checks": [
-                    lambda proc: proc.returncode != StatusCode.SEGFAULT,
-                    lambda proc: len(proc.stdout.splitlines()) == 1,
-                    lambda proc: proc.stdout.splitlines()[0].startswith("rpm-"),
-                ],
+                "checks": _SINGLE_RPM_CHECKS,
             },
             "Requirename": {
                 "cmd": [
@@ -198,14 +305,7 @@ class RPMUtil:
                     "--dbpath",
                     self.dbpath,
                 ],
-                "checks": [
-                    lambda proc: proc.returncode != StatusCode.SEGFAULT,
-                    lambda proc: len(proc.stdout.splitlines()) >= 1,
-                    lambda proc: any(
-                        line.startswith("rpm-") or line.startswith("yum-")
-                        for line in proc.stdout.splitlines()
-                    ),
-                ],
+                "checks": (_not_segfault, _has_output, _any_line_is_rpm_or_yum),
             },
             "Recommendname": None,
             "Dirnames": None,
@@ -218,98 +318,123 @@ class RPMUtil:
             "Supplementname": None,  # rarely used
             "Transfiletriggername": None,  # rarely used
             "Triggername": None,  # rarely used
-        }  # type: t.Dict[str, t.Optional[t.Dict[str, t.Union[t.Sequence[str], t.Sequence[t.Callable[[CompletedProcess], bool]]]]]]
-
-        # Checks for Packages db corruption
-        post_checks = [
-            lambda proc: not any(
-                "cannot open Packages database" in line
-                for line in proc.stderr.splitlines()
-            ),
-            lambda proc: any(
-                "missing index" in line for line in proc.stderr.splitlines()
-            ),
-        ]
+        }  # type: t.Dict[str, t.Optional[t.Dict[str, t.Union[t.Sequence[str], t.Sequence[t.Callable[[CompletedProcess, t.List[str]], bool]]]]]]
+        self._rpmdb_indexes = rpmdb_indexes
+        self._rpmdb_indexes_key = key
+        return rpmdb_indexes
+
+    def check_rpmdb_indexes(self):
+        # type: () -> None
+        """
+        For each rpmdb file we define a rpm command that blows up on inconsistencies,
+        or returns incorrect results. Structure:
+        'name_of_file': {
+            'cmd': 'str', # rpm command
+            'checks': [], # list of conditions to be met
+        }
+        """
+        if sys.platform == "darwin":
+            self.logger.debug("check_rpmdb_indexes is not implemented for darwin")
+            return
 
+        rpmdb_indexes = self._rpmdb_index_probes()
+
+        # One directory listing instead of a stat per index
+        existing = set(os.listdir(self.dbpath))
         for index, config in rpmdb_indexes.items():
-            # Skip over indexes with no defined checks / conditions
-            if not config:
-                continue
+            # Skip over non existing indexes
+            if config and index not in existing:
+                self.logger.info("{} does not exist".format(index))
+        # Skip over indexes with no defined checks / conditions
+        probes = [
+            # pyre-ignore[6]: config["cmd"] and config["checks"]
+            (index, config["cmd"], config["checks"])
+            for index, config in rpmdb_indexes.items()
+            if config and index in existing
+        ]
 
-            try:
-                # Skip over non existing indexes
-                if not os.path.join(self.dbpath, index):
-                    self.logger.info("{} does not exist".format(index))
-                    continue
+        try:
+            # The probes only read the rpmdb, so run them concurrently like
+            # verify_tables does. Deleting and rebuilding stays serial below.
+            if (
+                ThreadPoolExecutor is not None
+                and SUBPROCESS_TIMEOUTS
+                and len(probes) > 1
+            ):
+                with ThreadPoolExecutor(min(VERIFY_JOBS, len(probes))) as pool:
+                    needs_rebuild = list(pool.map(self._index_needs_rebuild, probes))
+            else:
+                needs_rebuild = [self._index_needs_rebuild(probe) for probe in probes]
+        except DcRPMException:
+            self.logger.info("RPM commands are failing too hard")
+            raise DBNeedsRecovery()
 
-                self.logger.info("Attempting to selectively poke at %s index", index)
-                if t:
-                    self._poke_index(
-                        t.cast(t.List[str], config["cmd"]),
-                        t.cast(
-                            t.List[t.Callable[[CompletedProcess], bool]],
-                            config["checks"],
-                        ),
-                    )
-                else:
-                    # pyre-ignore[6]: config["cmd"] and config["checks"]
-                    self._poke_index(config["cmd"], config["checks"])
-
-            except DBIndexNeedsRebuild:
-                self.status_logger.info(RepairAction.INDEX_REBUILD)
-                index_path = os.path.join(self.dbpath, index)
-                if os.path.isfile(index_path):
-                    self.logger.info("%s index is out of whack, deleting it", index)
-                    os.remove(index_path)
-                else:
-                    self.logger.info("%s index is missing", index)
-
-                # Run the same command again, which should trigger a rebuild
-                if t:
-                    proc = self._poke_index(t.cast(t.List[str], config["cmd"]), [])
-                else:
-                    # pyre-ignore[6]: config["cmd"]
-                    proc = self._poke_index(config["cmd"], [])
-
-                # Sometimes single index rebuilds don't work, as rpm fails to
-                # open Packages db. In that case we'll try a full recovery
-                for check in post_checks:
-                    if not check(proc):
-                        self.logger.info("Granular index rebuild failed")
-                        raise DBNeedsRecovery()
-
-            except DcRPMException:
-                self.logger.info("RPM commands are failing too hard")
-                raise DBNeedsRecovery()
+        for (index, cmd, _), bad in zip(probes, needs_rebuild):
+            if not bad:
+                continue
+
+            self.status_logger.info(RepairAction.INDEX_REBUILD)
+            index_path = os.path.join(self.dbpath, index)
+            if os.path.isfile(index_path):
+                self.logger.info("%s index is out of whack, deleting it", index)
+                os.remove(index_path)
+            else:
+                self.logger.info("%s index is missing", index)
+
+            # Run the same command again, which should trigger a rebuild
+            proc = self._poke_index(cmd, [])
+
+            # Sometimes single index rebuilds don't work, as rpm fails to
+            # open Packages db. In that case we'll try a full recovery
+            for check in _POST_REBUILD_CHECKS:
+                if not check(proc):
+                    self.logger.info("Granular index rebuild failed")
+                    raise DBNeedsRecovery()
+
+    def _index_needs_rebuild(self, probe):
+        # type: (t.Tuple[str, t.List[str], t.Sequence[t.Callable[[CompletedProcess, t.List[str]], bool]]]) -> bool
+        index, cmd, checks = probe
+        self.logger.info("Attempting to selectively poke at %s index", index)
+        try:
+            self._poke_index(cmd, checks)
+        except DBIndexNeedsRebuild:
+            return True
+        return False
 
     def check_rpm_qa(self):
         # type: () -> None
         """
         Runs `rpm -qa` which serves as a good proxy check for whether bdb needs recovery
         """
+        # Ask for just the names so check_tables can reuse this listing.
+        self._qa_names = None
         try:
             result = run_with_timeout(
-                [self.rpm_path, "--dbpath", self.dbpath, "-qa"], RPM_CHECK_TIMEOUT_SEC
+                [self.rpm_path, "--dbpath", self.dbpath, "-qa", "--qf", "%{NAME}\\n"],
+                RPM_CHECK_TIMEOUT_SEC,
             )
         except DcRPMException:
             self.logger.error("rpm -qa failed")
             self.status_logger.warning("initial_db_check_fail")
             raise DBNeedsRecovery()
 
-        packages = result.stdout.strip().split()
+        # One package per line; count them without building a list.
+        stdout = result.stdout.strip()
+        package_count = stdout.count("\n") + 1 if stdout else 0
         # This test only makes sense on Linux; on macOS RPM is not the native
         # package manager, so a freshly-installed system can have
         # very few RPMs
         if read_os_name() == "Linux":
-            if len(packages) < MIN_ACCEPTABLE_PKG_COUNT:
+            if package_count < MIN_ACCEPTABLE_PKG_COUNT:
                 self.logger.error(
                     "rpm package count seems too low; saw %d, expected at least %d",
-                    len(packages),
+                    package_count,
                     MIN_ACCEPTABLE_PKG_COUNT,
                 )
                 raise DBNeedsRecovery()
 
-        self.logger.debug("Package count: %d", len(packages))
+        self.logger.debug("Package count: %d", package_count)
+        self._qa_names = result.stdout
 
     def query(self, rpm_name):
         # type: (str) -> None
@@ -380,15 +505,28 @@ class RPMUtil:
         which checks each rpm in the DB to see if there are inconsistencies between what
         rpm thinks is installed and what is in the DB.
         """
+        # Reuse the listing from a check_rpm_qa that passed earlier in this run,
+        # rather than walking the whole db again. It's only used once so a
+        # listing taken before a recovery or rebuild is never picked up.
+        qa_names = self._qa_names
+        self._qa_names = None
         try:
-            result = run_with_timeout(
-                [self.rpm_path, "--dbpath", self.dbpath, "-qa", "--qf", "%{NAME}\\n"],
-                timeout=RPM_CHECK_TIMEOUT_SEC,
-                exception_to_raise=DBNeedsRebuild,
-            )
+            if qa_names is None:
+                qa_names = run_with_timeout(
+                    [
+                        self.rpm_path,
+                        "--dbpath",
+                        self.dbpath,
+                        "-qa",
+                        "--qf",
+                        "%{NAME}\\n",
+                    ],
+                    timeout=RPM_CHECK_TIMEOUT_SEC,
+                    exception_to_raise=DBNeedsRebuild,
+                ).stdout
 
             # Assume healthy if no RPMs listed.
-            rpms = sorted(set(result.stdout.splitlines()))
+            rpms = sorted(set(qa_names.splitlines()))
             if not rpms:
                 return
             result = run_with_timeout(
@@ -401,8 +539,9 @@ class RPMUtil:
             self.status_logger.warning("initial_table_check_fail")
             raise
 
+        # Stop scanning at the first package rpm claims isn't installed.
         lines = result.stdout.splitlines()
-        if any([line.endswith("is not installed") for line in lines]):
+        if any(line.endswith("is not installed") for line in lines):
             raise DBNeedsRebuild()
 
     def verify_tables(self):
@@ -410,26 +549,41 @@ class RPMUtil:
         """
         Runs `db_verify` on all rpmdb tables.
         """
+        blacklist = frozenset(self.blacklist)
+        paths = []  # type: t.List[str]
         for table in self.tables:
-            if os.path.basename(table) in self.blacklist:
+            if os.path.basename(table) in blacklist:
                 self.logger.warning("Skipping table '%s', blacklisted", table)
                 continue
+            paths.append(os.path.join(self.dbpath, table))
 
-            try:
-                result = run_with_timeout(
-                    [self.verify_path, os.path.join(self.dbpath, table)],
-                    VERIFY_TIMEOUT_SEC,
-                    raise_on_nonzero=False,
-                )
-            except DcRPMException:
-                self.status_logger.warning("initial_table_verify_fail")
-                raise
+        try:
+            # Each table is a separate file, so verify them concurrently. That
+            # needs run_with_timeout to work off the main thread.
+            if (
+                ThreadPoolExecutor is not None
+                and SUBPROCESS_TIMEOUTS
+                and len(paths) > 1
+            ):
+                with ThreadPoolExecutor(min(VERIFY_JOBS, len(paths))) as pool:
+                    results = list(pool.map(self._db_verify, paths))
+            else:
+                results = [self._db_verify(path) for path in paths]
+        except DcRPMException:
+            self.status_logger.warning("initial_table_verify_fail")
+            raise
+
+        # This raises a DcRPMException because it gets handled specially in
+        # the main run loop.
+        if any(result.returncode != 0 for result in results):
+            self.logger.error("db_verify returned nonzero status")
+            raise DcRPMException()
 
-            # This raises a DcRPMException because it gets handled specially in
-            # the main run loop.
-            if result.returncode != 0:
-                self.logger.error("db_verify returned nonzero status")
-                raise DcRPMException()
+    def _db_verify(self, path):
+        # type: (str) -> CompletedProcess
+        return run_with_timeout(
+            [self.verify_path, path], VERIFY_TIMEOUT_SEC, raise_on_nonzero=False
+        )
 
     def clean_yum_transactions(self):
         # type: () -> None
@@ -452,25 +606,31 @@ class RPMUtil:
         Find and kill any rpm query processes over an hour old by looking explicitly for
         `rpm -q`.
         """
-        for proc in psutil.process_iter():
+        # Have psutil fetch what we need up front rather than a separate /proc
+        # read per accessor; inaccessible values come back as None.
+        now = time.time()
+        for proc in psutil.process_iter(attrs=["cmdline", "create_time"]):
             try:
-                cmd = proc.cmdline()
+                cmd = proc.info["cmdline"]
                 # Valid command
                 if not cmd or len(cmd) < 2:
                     continue
                 # Looks like rpm
-                if not (re.match(r"(/(usr/)?bin/)?rpm", cmd[0]) and "-q" in cmd):
+                if not ("rpm" in cmd[0] and _RPM_CMD_RE.match(cmd[0]) and "-q" in cmd):
                     continue
 
                 self.logger.info("Considering pid %s", proc.pid)
-                ctime = proc.create_time()
+                ctime = proc.info["create_time"]
+                if ctime is None:
+                    self.logger.warning("Skipping pid %d, cannot access it", proc.pid)
+                    continue
 
-                if time.time() - ctime > kill_after_seconds:
+                if now - ctime > kill_after_seconds:
                     self.logger.error(
                         "Found stale rpm process: (%d) %s", proc.pid, " ".join(cmd)
                     )
                     proc.send_signal(signal.SIGKILL)
-                    proc.wait(timeout=kill_timeout)
+                    pidutil.wait_for_exit(proc, timeout=kill_timeout)
 
             except psutil.NoSuchProcess:
                 self.logger.warning("Skipping pid %d, it disappeared", proc.pid)
@@ -490,14 +650,14 @@ class RPMUtil:
             timeout=RPM_CHECK_TIMEOUT_SEC,
         )
         macros = {}  # type: t.Dict[str, str]
-        for line in result.stdout.splitlines():
-            # TODO: make this parse multi-line macros properly
-            m = re.match(r"^-\d+:\s+(\w+)\s+([\w\s]+)$", line)
-            if m:
-                key = m.group(1)
-                val = m.group(2)
-                if key and val:
-                    macros[key] = val
+        # Scan the output in place rather than splitting it into a list of lines
+        # first; --showrc is large and only a few lines are macros we can parse.
+        # TODO: make this parse multi-line macros properly
+        for m in _MACRO_RE.finditer(result.stdout):
+            key = m.group(1)
+            val = m.group(2)
+            if key and val:
+                macros[key] = val
 
         self.logger.debug("RPM macros = %s" % macros)
         return macros
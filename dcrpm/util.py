@@ -10,11 +10,21 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import errno
+import functools
+import io
 import logging
 import os
+import select
 import signal
 import subprocess
 
+try:
+    from functools import lru_cache
+except ImportError:
+    # python 2
+    lru_cache = None
+
 try:
     import typing as t
 
@@ -25,6 +35,9 @@ except ImportError:
 
 
 END_TIMEOUT = 5  # type: int
+# Python 3's Popen.communicate/wait take a timeout, python 2's don't. Without
+# it run_with_timeout falls back to SIGALRM and must stay on the main thread.
+SUBPROCESS_TIMEOUTS = hasattr(subprocess, "TimeoutExpired")  # type: bool
 
 _logger = logging.getLogger()  # type: logging.Logger
 
@@ -123,13 +136,20 @@ ACTION_NAMES = {
 # pyre-ignore[2,3]: workaround pyre bug
 def memoize(f):
     # type: (t.Callable[..., t.TypeVar("RT")]) -> t.Callable[..., t.TypeVar("RT")]
+    """
+    Caches f's result per set of (hashable) arguments. Uses functools.lru_cache
+    where available; python 2 gets a plain dict keyed on the args themselves.
+    """
+    if lru_cache is not None:
+        return lru_cache(maxsize=128)(f)
 
-    cache = {}  # type: t.Dict[str, t.TypeVar("RT")]
+    cache = {}  # type: t.Dict[t.Hashable, t.TypeVar("RT")]
 
+    @functools.wraps(f)
     # pyre-ignore[2]: *args and **kwargs
     def wrapper(*args, **kwargs):
         # type: (t.Any, t.Any) -> t.TypeVar("RT")
-        key = str(args) + str(kwargs)
+        key = (args, frozenset(kwargs.items())) if kwargs else args
         if key not in cache:
             cache[key] = f(*args, **kwargs)
         return cache[key]
@@ -147,7 +167,7 @@ def alarm_handler(signum, frame):
 
 def call_with_timeout(
     func,  # type: t.Callable[..., t.TypeVar("RT")]
-    timeout,  # type: int
+    timeout,  # type: float
     args=None,  # type: t.Optional[t.Iterable[str]]
     # pyre-ignore[2]: kwargs has type dict[str, Any]
     kwargs=None,  # type: t.Optional[t.Dict[str, t.Any]]
@@ -155,10 +175,7 @@ def call_with_timeout(
     # type: (...) -> t.TypeVar("RT")
     """
     A generic method that calls some callable and uses SIGALRM to time out the
-    call should it take longer than `timeout`.
-    If `raise_` is True, then it will raise a TimeoutExpired exception
-    indicating the callable timed out. If `raise_` is False and the call times
-    out, this function returns None.
+    call should it take longer than `timeout`, raising TimeoutExpired.
     `args` is a list of arguments to pass to the callable (like *args)
     `kwargs` is a dict of keyword arguments to pass to the callable (like
     **kwargs)
@@ -170,14 +187,59 @@ def call_with_timeout(
 
     # Handle command timeouts.
     # from: https://stackoverflow.com/a/1191537
+    # setitimer rather than alarm, which only takes whole seconds; both deliver
+    # SIGALRM.
     signal.signal(signal.SIGALRM, alarm_handler)
-    signal.alarm(timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
     try:
         return func(*args, **kwargs)
     finally:
-        signal.alarm(0)
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _call_subprocess_with_timeout(func, timeout):
+    # type: (t.Callable[..., t.TypeVar("RT")], int) -> t.TypeVar("RT")
+    """
+    Calls a Popen method that takes a `timeout` (communicate, wait), raising
+    TimeoutExpired if it runs over. Python 3 handles the timeout itself, which
+    unlike SIGALRM also works off the main thread; python 2 falls back to
+    call_with_timeout.
+    """
+    if SUBPROCESS_TIMEOUTS:
+        try:
+            return func(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise TimeoutExpired()
+    return call_with_timeout(func, timeout)
 
-    raise DcRPMException("should not get here")
+
+@memoize
+def _spawn_close_fds():
+    # type: () -> bool
+    """
+    Returns the close_fds value for run_with_timeout's Popen. fds Python opens
+    itself are non-inheritable (PEP 446), but ones dcrpm inherited from its own
+    parent (cron, a config management agent, a wrapper script) are not, and
+    would otherwise leak into every rpm/db_* child. So mark everything above
+    stderr close-on-exec once, and only ask Popen to close fds if that fails.
+    """
+    if not hasattr(os, "set_inheritable"):
+        # python 2 has no PEP 446, and always spawned with close_fds=False.
+        return False
+    try:
+        fds = os.listdir("/dev/fd")
+    except OSError:
+        return True
+    for fd in fds:
+        fd = int(fd)
+        if fd <= 2:
+            continue
+        try:
+            os.set_inheritable(fd, False)
+        except OSError:
+            # The fd listdir used for /dev/fd itself, closed by now.
+            pass
+    return False
 
 
 def run_with_timeout(
@@ -196,12 +258,23 @@ def run_with_timeout(
     if not cmd:
         raise ValueError("must pass command to run")
 
-    _logger.debug("Running %s", " ".join(cmd))
+    if _logger.isEnabledFor(logging.DEBUG):
+        _logger.debug("Running %s", " ".join(cmd))
+    # Once _spawn_close_fds has marked the fds we inherited close-on-exec,
+    # there is nothing left for close_fds to do. Leaving it off lets Python
+    # 3.8+ spawn via posix_spawn (vfork) instead of fork+exec, which is much
+    # cheaper for a large parent. bufsize=-1 is already the default on Python
+    # 3, but Python 2 defaults to unbuffered pipes.
     proc = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        close_fds=_spawn_close_fds(),
+        bufsize=-1,
     )
     try:
-        stdout, stderr = call_with_timeout(proc.communicate, timeout)
+        stdout, stderr = _call_subprocess_with_timeout(proc.communicate, timeout)
     except TimeoutExpired:
         msg = "%s timed out after %d" % (cmd[0], timeout)
         _logger.error(msg)
@@ -223,6 +296,41 @@ def run_with_timeout(
     return CompletedProcess(returncode=rc, stdout=stdout, stderr=stderr)
 
 
+def wait_pidfd(pid, timeout):
+    # type: (int, float) -> t.Optional[bool]
+    """
+    Sleeps until `pid` exits or `timeout` seconds pass by polling a pidfd,
+    rather than busy-waiting. Returns whether the process exited, or None if
+    pidfds aren't available (Python < 3.9 or Linux < 5.3).
+    """
+    pidfd_open = getattr(os, "pidfd_open", None)
+    if pidfd_open is None:
+        return None
+    try:
+        fd = pidfd_open(pid)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return True
+        return None
+
+    try:
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        return bool(poller.poll(timeout * 1000))
+    finally:
+        os.close(fd)
+
+
+def _wait_child(proc, timeout):
+    # type: (subprocess.Popen, int) -> int
+    """
+    proc.wait() with a timeout, sleeping on a pidfd where possible instead of
+    Popen.wait's poll-and-sleep loop. Raises TimeoutExpired.
+    """
+    exited = wait_pidfd(proc.pid, timeout)
+    return _call_subprocess_with_timeout(proc.wait, timeout if exited is None else 0)
+
+
 def kindly_end(proc, timeout=END_TIMEOUT):
     # type: (subprocess.Popen, int) -> int
     """
@@ -233,12 +341,12 @@ def kindly_end(proc, timeout=END_TIMEOUT):
     try:
         _logger.info("Sending SIGTERM to %d", proc.pid)
         proc.terminate()
-        rc = call_with_timeout(proc.wait, timeout)
+        rc = _wait_child(proc, timeout)
     except TimeoutExpired:
         _logger.warning("Could not SIGTERM %d, sending SIGKILL", proc.pid)
         try:
             proc.kill()
-            rc = call_with_timeout(proc.wait, timeout)
+            rc = _wait_child(proc, timeout)
         except TimeoutExpired:
             _logger.error("Could not SIGKILL %d, good luck", proc.pid)
 
@@ -268,8 +376,12 @@ def which(cmd):
 def read_os_name():
     # type: () -> str
     """
-    Call platform.system() and caches the value
+    Returns the OS name ("Linux", "Darwin"), like platform.system() but straight
+    from uname(2) so we don't pay for importing platform. Cached.
     """
+    if hasattr(os, "uname"):
+        return os.uname()[0]
+
     import platform
 
     return platform.system()
@@ -284,11 +396,14 @@ def read_os_release():
     """
     data = {}
     if os.path.exists("/etc/os-release"):
-        with open("/etc/os-release", "r") as f:
+        # Explicit buffer size: st_blksize is meaningless on procfs-like
+        # filesystems and can leave us with tiny reads.
+        with io.open("/etc/os-release", "r", buffering=8192, encoding="utf-8") as f:
             for line in f:
-                if line.strip() == "":
+                # partition keeps any "=" inside the value, e.g. FOO="a=b"
+                (key, sep, value) = line.partition("=")
+                if not sep:
                     continue
-                (key, value) = line.split("=", 2)
-                data[key.strip()] = value.strip()
+                data[key.strip()] = value.strip().strip("\"'")
 
     return data
@@ -19,11 +19,17 @@ from .util import (
     DBNeedsRebuild,
     DcRPMException,
     RepairAction,
+    memoize,
     read_os_name,
     run_with_timeout,
     which,
 )
 
+try:
+    import typing as t
+except ImportError:
+    pass
+
 
 YUM_PID_PATH = "/var/run/yum.pid"  # type: str
 YUM_TIMEOUT_SEC = 30  # type: int
@@ -34,25 +40,37 @@ DNF_CMD_NAME = "dnf"  # type: str
 KILL_TIMEOUT = 5  # type: int
 
 
+@memoize
+def _find_yum():
+    # type: () -> t.Optional[str]
+    """
+    Returns whichever of yum or dnf is installed, or None. which() only caches
+    hits, so this keeps dnf-only hosts from rescanning $PATH for yum every time a
+    Yum is constructed.
+    """
+    for cmd in (YUM_CMD_NAME, DNF_CMD_NAME):
+        try:
+            which(cmd)
+            return cmd
+        except DcRPMException:
+            continue
+    return None
+
+
 class Yum:
     def __init__(self):
         # type: () -> None
         self.logger = logging.getLogger()  # type: logging.Logger
         self.status_logger = logging.getLogger("status")  # type: logging.Logger
-        self.yum = YUM_CMD_NAME  # type: str
-        try:
-            which(self.yum)
-        except DcRPMException:
-            try:
-                self.yum = DNF_CMD_NAME
-                which(self.yum)
-            except DcRPMException:
-                self.yum = YUM_CMD_NAME
-                m = "Neither yum nor dnf was found!"
-                if read_os_name() == "Darwin":
-                    self.logger.warning(m)
-                else:
-                    raise DcRPMException(m)
+        yum = _find_yum()
+        if yum is None:
+            yum = YUM_CMD_NAME
+            m = "Neither yum nor dnf was found!"
+            if read_os_name() == "Darwin":
+                self.logger.warning(m)
+            else:
+                raise DcRPMException(m)
+        self.yum = yum  # type: str
 
         self.logger.info("Using %s for yum" % self.yum)
 
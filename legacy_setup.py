@@ -53,7 +53,7 @@ setup(
     long_description=open("README.md", "r").read(),
     long_description_content_type="text/markdown",
     license="GPLv2",
-    install_requires=["psutil"],
+    install_requires=["psutil>=5.3.0"],
     tests_require=tests_require,
     test_suite="tests",
     entry_points={"console_scripts": ["dcrpm=dcrpm.main:main"]},
@@ -17,9 +17,9 @@ from dcrpm.util import TimeoutExpired
 
 
 try:
-    from unittest.mock import create_autospec
+    from unittest.mock import Mock
 except ImportError:
-    from mock import create_autospec
+    from mock import Mock
 
 
 MockPopenFile = t.NamedTuple("MockPopenFile", [("path", str)])
@@ -48,7 +48,9 @@ def make_mock_process(
     cmd = cmdline.split()
     if len(cmd) > 1 and name == "":
         name = cmd[0]
-    mock_process = create_autospec(psutil.Process)
+    # A plain spec rather than create_autospec: autospeccing introspects every
+    # psutil.Process method signature and dominated the cost of each mock.
+    mock_process = Mock(spec=psutil.Process)
     mock_process.pid = pid
     mock_process.create_time.return_value = create_time
     mock_process.name.return_value = name
@@ -73,9 +75,17 @@ def make_mock_process(
         mock_process.wait.side_effect = psutil.TimeoutExpired(5)
     else:
         mock_process.wait.return_value = None
+    # psutil.wait_procs checks is_running() when wait() returns no exit code.
+    mock_process.is_running.return_value = wait_throw
     if cmdline_throw:
         mock_process.cmdline.side_effect = psutil.NoSuchProcess(pid)
     else:
         mock_process.cmdline.return_value = cmd
+    # What psutil.process_iter(attrs=...) fills in; failures show up as None.
+    mock_process.info = {
+        "pid": pid,
+        "cmdline": None if cmdline_throw else cmd,
+        "create_time": create_time,
+    }
 
     return mock_process
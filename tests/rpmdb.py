@@ -54,9 +54,9 @@ class RPMDB:
         if os.path.isfile(file) and tarfile.is_tarfile(file):
             try:
                 temp_dir = tempfile.mkdtemp()
-                tar = tarfile.open(file)
-                tar.extractall(temp_dir)
-                tar.close()
+                # Stream mode: extraction is a single pass, no seeking needed.
+                with tarfile.open(file, "r|gz") as tar:
+                    tar.extractall(temp_dir)
             except Exception:
                 raise Exception("Failed to extract {}".format(file))
         else:
@@ -11,6 +11,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import argparse
+import errno
 import os
 import typing as t
 from os.path import join
@@ -111,16 +112,11 @@ class TestDcRPM(testslide.TestCase):
         self.dcrpm.run_rebuild()
 
     # hardlink_db001
-    def test_hardlink_db001_link_exists(self):
+    def test_hardlink_db001_success(self):
         # type: () -> None
         old = join(self.dbpath, "__db.001")
         new = join(self.dbpath, "__dcrpm_py_inode_pointer")
-        (
-            self.mock_callable(os, "unlink")
-            .for_call(new)
-            .to_raise(OSError())
-            .and_assert_called_once()
-        )
+        self.mock_callable(os, "unlink").and_assert_not_called()
         (
             self.mock_callable(os, "link")
             .for_call(old, new)
@@ -130,20 +126,38 @@ class TestDcRPM(testslide.TestCase):
         p = self.dcrpm.hardlink_db001()
         self.assertEqual(p, new)
 
-    def test_hardlink_db001_symlink_fails(self):
+    def test_hardlink_db001_link_exists(self):
         # type: () -> None
         old = join(self.dbpath, "__db.001")
         new = join(self.dbpath, "__dcrpm_py_inode_pointer")
+        links = []  # type: t.List[t.Tuple[str, str]]
+
+        def fake_link(src, dst):
+            # type: (str, str) -> None
+            links.append((src, dst))
+            if len(links) == 1:
+                raise OSError(errno.EEXIST, "File exists")
+
         (
             self.mock_callable(os, "unlink")
             .for_call(new)
             .to_return_value(None)
             .and_assert_called_once()
         )
+        self.mock_callable(os, "link").with_implementation(fake_link)
+        p = self.dcrpm.hardlink_db001()
+        self.assertEqual(p, new)
+        self.assertEqual(links, [(old, new), (old, new)])
+
+    def test_hardlink_db001_symlink_fails(self):
+        # type: () -> None
+        old = join(self.dbpath, "__db.001")
+        new = join(self.dbpath, "__dcrpm_py_inode_pointer")
+        self.mock_callable(os, "unlink").and_assert_not_called()
         (
             self.mock_callable(os, "link")
             .for_call(old, new)
-            .to_raise(OSError())
+            .to_raise(OSError(errno.ENOENT, "No such file or directory"))
             .and_assert_called_once()
         )
         with self.assertRaises(util.DcRPMException):
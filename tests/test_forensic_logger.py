@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the GPLv2 license found in the LICENSE
+# file in the root directory of this source tree.
+#
+# pyre-strict
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import os
+import shutil
+import tempfile
+
+import testslide
+from dcrpm.forensic_logger import ForensicLogger
+
+
+class TestForensicLogger(testslide.TestCase):
+    def setUp(self):
+        # type: () -> None
+        super(TestForensicLogger, self).setUp()
+        self.logdir = tempfile.mkdtemp()  # type: str
+        self.addCleanup(shutil.rmtree, self.logdir)
+        self.handler = ForensicLogger(self.logdir)  # type: ForensicLogger
+
+    def make_record(self, msg):
+        # type: (str) -> logging.LogRecord
+        record = logging.LogRecord(
+            "forensic", logging.DEBUG, __file__, 0, msg, None, None
+        )
+        record.key = "db_stat"
+        return record
+
+    def read_dump(self):
+        # type: () -> bytes
+        (name,) = os.listdir(self.logdir)
+        self.assertTrue(name.startswith("db_stat."))
+        with open(os.path.join(self.logdir, name), "rb") as f:
+            return f.read()
+
+    def test_debug_writes_dump(self):
+        # type: () -> None
+        self.handler.emit(self.make_record("some output\n"))
+        self.assertEqual(self.read_dump(), b"some output\n")
+
+    def test_debug_retries_short_writes(self):
+        # type: () -> None
+        real_write = os.write
+        (
+            self.mock_callable(os, "write")
+            .with_implementation(lambda fd, data: real_write(fd, data[:3]))
+            .and_assert_called()
+        )
+        self.handler.emit(self.make_record("some output\n"))
+        self.assertEqual(self.read_dump(), b"some output\n")
+
+    def test_debug_needs_key(self):
+        # type: () -> None
+        record = self.make_record("some output\n")
+        del record.key
+        self.handler.emit(record)
+        self.assertEqual(os.listdir(self.logdir), [])
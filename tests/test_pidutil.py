@@ -10,20 +10,24 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import ctypes
+import mmap
 import os
+import shutil
 import signal
+import subprocess
 import sys
+import tempfile
 import typing as t
+import unittest
 
+import psutil
 import testslide
 from dcrpm import pidutil
 from dcrpm.util import CompletedProcess, DcRPMException
 from tests.mock_process import make_mock_process
 
 
-if t.TYPE_CHECKING:
-    import psutil
-
 try:
     from unittest.mock import mock_open
 except ImportError:
@@ -40,9 +44,19 @@ stat_result = t.NamedTuple("stat_result", [("st_mtime", int)])
 
 
 class TestPidutil(testslide.TestCase):
+
+    def setUp(self):
+        # type: () -> None
+        super(TestPidutil, self).setUp()
+        # Mock processes have made-up pids, don't go looking for real ones.
+        self.mock_callable(pidutil, "wait_pidfd").to_return_value(None)
+
     # procs_holding_file
     def test_procs_holding_file_no_lsof(self):
         # type: () -> None
+        self.mock_callable(pidutil, "_has_procfs", allow_private=True).to_return_value(
+            False
+        )
         (
             self.mock_callable(pidutil, "which")
             .to_return_value(None)
@@ -51,36 +65,147 @@ class TestPidutil(testslide.TestCase):
         with self.assertRaises(DcRPMException):
             pidutil.procs_holding_file("/tmp/foo")
 
-    # _pids_holding_file
-    def test__pids_holding_file_timeout(self):
+    def test_procs_holding_file_procfs(self):
+        # type: () -> None
+        self.mock_callable(pidutil, "_has_procfs", allow_private=True).to_return_value(
+            True
+        )
+        self.mock_callable(pidutil, "which").and_assert_not_called()
+        (
+            self.mock_callable(
+                pidutil, "_pids_holding_files_procfs", allow_private=True
+            )
+            .for_call(["/tmp/foo"])
+            .to_return_value(set())
+            .and_assert_called_once()
+        )
+        self.assertEqual(pidutil.procs_holding_file("/tmp/foo"), set())
+
+    # _pids_holding_files_procfs
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "requires procfs")
+    def test__pids_holding_files_procfs_success(self):
+        # type: () -> None
+        with tempfile.NamedTemporaryFile() as f:
+            self.assertIn(os.getpid(), pidutil._pids_holding_files_procfs([f.name]))
+
+    def test__pids_holding_files_procfs_missing(self):
+        # type: () -> None
+        self.assertEqual(
+            pidutil._pids_holding_files_procfs(["/this/path/does/not/exist"]), set()
+        )
+
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "requires procfs")
+    def test__pids_holding_files_procfs_hardlink(self):
+        # type: () -> None
+        # Mirrors run_recovery: the original file is gone, only the link is left.
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, "__db.001")
+            hardlink = os.path.join(temp_dir, "__dcrpm_py_inode_pointer")
+            with open(path, "w"):
+                os.link(path, hardlink)
+                os.unlink(path)
+                pids = pidutil._pids_holding_files_procfs([hardlink])
+            self.assertIn(os.getpid(), pids)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "requires procfs")
+    def test__pids_holding_files_procfs_mmap_only(self):
+        # type: () -> None
+        # Berkeley DB keeps its region files mapped after closing the fd. Python's
+        # mmap module dups the fd, so map through libc to leave no fd behind.
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_size_t,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_long,
+        ]
+        libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, "__db.001")
+            hardlink = os.path.join(temp_dir, "__dcrpm_py_inode_pointer")
+            with open(path, "wb") as f:
+                f.write(b"\0" * mmap.PAGESIZE)
+            with open(path, "rb") as f:
+                region = libc.mmap(
+                    None, mmap.PAGESIZE, mmap.PROT_READ, mmap.MAP_SHARED, f.fileno(), 0
+                )
+            self.assertNotEqual(region, ctypes.c_void_p(-1).value)
+            try:
+                os.link(path, hardlink)
+                os.unlink(path)
+                pids = pidutil._pids_holding_files_procfs([hardlink])
+            finally:
+                libc.munmap(region, mmap.PAGESIZE)
+            self.assertIn(os.getpid(), pids)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "requires procfs")
+    def test__pids_holding_files_procfs_symlink(self):
+        # type: () -> None
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, ".rpm.lock")
+            symlink = os.path.join(temp_dir, "symlink")
+            os.symlink(path, symlink)
+            with open(path, "w"):
+                pids = pidutil._pids_holding_files_procfs([symlink])
+            self.assertIn(os.getpid(), pids)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "requires procfs")
+    def test__pids_holding_files_procfs_multiple(self):
+        # type: () -> None
+        with tempfile.NamedTemporaryFile() as f:
+            pids = pidutil._pids_holding_files_procfs(
+                ["/this/path/does/not/exist", f.name]
+            )
+            self.assertIn(os.getpid(), pids)
+
+    # _pids_holding_files
+    def test__pids_holding_files_timeout(self):
         # type: () -> None
         (
             self.mock_callable(pidutil, "run_with_timeout")
             .to_raise(DcRPMException())
             .and_assert_called_once
         )
-        self.assertFalse(pidutil._pids_holding_file("/path/to/lsof", "/tmp/foo"))
+        self.assertFalse(pidutil._pids_holding_files("/path/to/lsof", ["/tmp/foo"]))
 
-    def test__pids_holding_file_failed(self):
+    def test__pids_holding_files_failed(self):
         # type: () -> None
         (
             self.mock_callable(pidutil, "run_with_timeout")
             .to_return_value(CompletedProcess(returncode=1, stderr="oh no"))
             .and_assert_called_once
         )
-        self.assertFalse(pidutil._pids_holding_file("/path/to/lsof", "/tmp/foo"))
+        self.assertFalse(pidutil._pids_holding_files("/path/to/lsof", ["/tmp/foo"]))
 
-    def test__pids_holding_file_success(self):
+    def test__pids_holding_files_success(self):
         # type: () -> None
         (
             self.mock_callable(pidutil, "run_with_timeout")
+            .for_call(
+                ["/path/to/lsof", "-l", "-n", "-P", "-F", "p", "/tmp/a"],
+                pidutil.LSOF_TIMEOUT,
+                raise_on_nonzero=False,
+            )
             .to_return_value(
                 CompletedProcess(stdout="\n".join(["p12345", "f1", "p123456", "f1"]))
             )
             .and_assert_called_once
         )
         self.assertEqual(
-            set([12345, 123456]), pidutil._pids_holding_file("/path/to/lsof", "/tmp/a")
+            set([12345, 123456]),
+            pidutil._pids_holding_files("/path/to/lsof", ["/tmp/a"]),
         )
 
     # send_signal
@@ -129,7 +254,7 @@ class TestPidutil(testslide.TestCase):
             make_mock_process(12345, ["/tmp/a", "/tmp/2"], wait_throw=True),
             make_mock_process(54321, ["/tmp/1", "/tmp/3"]),
         ]  # type: t.List[psutil.Process]
-        self.assertTrue(pidutil.send_signals(procs, signal.SIGKILL))
+        self.assertTrue(pidutil.send_signals(procs, signal.SIGKILL, timeout=0))
 
     def test_send_signals_all_throw(self):
         # type: () -> None
@@ -137,7 +262,69 @@ class TestPidutil(testslide.TestCase):
             make_mock_process(12345, ["/tmp/a", "/tmp/2"], signal_throw=True),
             make_mock_process(54321, ["/tmp/1", "/tmp/3"], wait_throw=True),
         ]  # type: t.List[psutil.Process]
-        self.assertFalse(pidutil.send_signals(procs, signal.SIGKILL))
+        self.assertFalse(pidutil.send_signals(procs, signal.SIGKILL, timeout=0))
+
+
+class TestWaitForExit(testslide.TestCase):
+    # wait_for_exit
+    def test_wait_for_exit_pidfd(self):
+        # type: () -> None
+        proc = make_mock_process(12345, [])
+        (
+            self.mock_callable(pidutil, "wait_pidfd")
+            .for_call(12345, 5)
+            .to_return_value(True)
+            .and_assert_called_once()
+        )
+        pidutil.wait_for_exit(proc, 5)
+        # Whatever is left of the timeout, for a parent that reaps late.
+        proc.wait.assert_called_once()
+        self.assertLessEqual(proc.wait.call_args[1]["timeout"], 5)
+        self.assertGreater(proc.wait.call_args[1]["timeout"], 4)
+
+    def test_wait_for_exit_no_pidfd(self):
+        # type: () -> None
+        proc = make_mock_process(12345, [])
+        (
+            self.mock_callable(pidutil, "wait_pidfd")
+            .for_call(12345, 5)
+            .to_return_value(None)
+            .and_assert_called_once()
+        )
+        pidutil.wait_for_exit(proc, 5)
+        proc.wait.assert_called_once_with(timeout=5)
+
+    @unittest.skipUnless(hasattr(os, "pidfd_open"), "requires os.pidfd_open")
+    def test_wait_for_exit_reaped_late_by_its_parent(self):
+        # type: () -> None
+        # The parent reaps its `sleep` half a second after it turns into a
+        # zombie, which is when our pidfd fires.
+        parent = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import os, subprocess, sys, time\n"
+                "child = subprocess.Popen(['sleep', '30'])\n"
+                "print(child.pid)\n"
+                "sys.stdout.flush()\n"
+                "stat = '/proc/%d/stat' % child.pid\n"
+                "while open(stat).read().split(')')[-1].split()[0] != 'Z':\n"
+                "    time.sleep(0.01)\n"
+                "time.sleep(0.5)\n"
+                "child.wait()\n",
+            ],
+            stdout=subprocess.PIPE,
+        )
+        try:
+            pid = int(parent.stdout.readline())
+            proc = psutil.Process(pid)
+            os.kill(pid, signal.SIGKILL)
+            pidutil.wait_for_exit(proc, 5)
+            self.assertFalse(psutil.pid_exists(pid))
+        finally:
+            parent.kill()
+            parent.wait()
+            parent.stdout.close()
 
 
 class TestPidfileInfo(testslide.TestCase):
@@ -145,19 +332,21 @@ class TestPidfileInfo(testslide.TestCase):
         # type: () -> None
         super(TestPidfileInfo, self).setUp()
         self.mock_callable(builtins, "open").to_call_original()
-        self.mock_callable(os, "stat").to_call_original()
+        self.mock_callable(os, "fstat").to_call_original()
 
     def test_pidfile_info_sucess(self):
         # type: () -> None
+        opener = mock_open(read_data="12345")
+        opener.return_value.fileno.return_value = 42
         (
             self.mock_callable(builtins, "open")
             .for_call("/some/path")
-            .with_implementation(mock_open(read_data="12345"))
+            .with_implementation(opener)
             .and_assert_called_once()
         )
         (
-            self.mock_callable(os, "stat")
-            .for_call("/some/path")
+            self.mock_callable(os, "fstat")
+            .for_call(42)
             .to_return_value(stat_result(12345678))
             .and_assert_called_once()
         )
@@ -172,7 +361,7 @@ class TestPidfileInfo(testslide.TestCase):
             .with_implementation(mock_open(read_data="-1"))
             .and_assert_called_once()
         )
-        self.mock_callable(os, "stat").and_assert_not_called()
+        self.mock_callable(os, "fstat").and_assert_not_called()
         with self.assertRaises(ValueError):
             pid, _ = pidutil.pidfile_info("/something")
 
@@ -184,6 +373,6 @@ class TestPidfileInfo(testslide.TestCase):
             .with_implementation(mock_open(read_data="ooglybogly"))
             .and_assert_called_once()
         )
-        self.mock_callable(os, "stat").and_assert_not_called()
+        self.mock_callable(os, "fstat").and_assert_not_called()
         with self.assertRaises(ValueError):
             pid, _ = pidutil.pidfile_info("/something")
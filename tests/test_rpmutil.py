@@ -10,14 +10,23 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import logging
 import os
+import shutil
+import tempfile
 import time
 import typing as t  # noqa
 
 import psutil
 import testslide
-from dcrpm import rpmutil, util
-from dcrpm.util import CompletedProcess, DBNeedsRebuild, DBNeedsRecovery, DcRPMException
+from dcrpm import pidutil, rpmutil, util
+from dcrpm.util import (
+    CompletedProcess,
+    DBNeedsRebuild,
+    DBNeedsRecovery,
+    DcRPMException,
+    StatusCode,
+)
 from tests.mock_process import make_mock_process
 
 
@@ -124,6 +133,24 @@ class TestRPMUtil(testslide.TestCase):
         ).and_assert_called_once()
         self.rpmutil.check_rpm_qa()
 
+    def test_check_rpm_qa_one_too_few_packages_linux(self):
+        # type: () -> None
+        (
+            self.mock_callable(rpmutil, "run_with_timeout")
+            .to_return_value(
+                CompletedProcess(
+                    stdout="".join(
+                        "rpm{}\n".format(i)
+                        for i in range(rpmutil.MIN_ACCEPTABLE_PKG_COUNT - 1)
+                    )
+                )
+            )
+            .and_assert_called_once()
+        )
+        self.mock_callable(rpmutil, "read_os_name").to_return_value("Linux")
+        with self.assertRaises(DBNeedsRecovery):
+            self.rpmutil.check_rpm_qa()
+
     def test_check_rpm_qa_not_enough_packages_linux(self):
         # type: () -> None
         (
@@ -160,6 +187,170 @@ class TestRPMUtil(testslide.TestCase):
         except DBNeedsRecovery:
             self.fail("Package count check should be bypassed on macOS")
 
+    def test_populate_tables(self):
+        # type: () -> None
+        dbpath = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dbpath)
+        names = ("Packages", "Sha1header", "__db.001", ".rpm.lock", "Packages.bak")
+        for name in names:
+            open(os.path.join(dbpath, name), "w").close()
+        self.rpmutil.dbpath = dbpath
+        self.rpmutil.populate_tables()
+        self.assertEqual(sorted(self.rpmutil.tables), ["Packages", "Sha1header"])
+
+    def test_single_rpm_checks(self):
+        # type: () -> None
+        def passes(stdout, returncode=0):
+            # type: (str, int) -> bool
+            proc = CompletedProcess(stdout=stdout, returncode=returncode)
+            lines = proc.stdout.splitlines()
+            return all(check(proc, lines) for check in rpmutil._SINGLE_RPM_CHECKS)
+
+        self.assertTrue(passes("rpm-4.14.2-1.x86_64\n"))
+        self.assertFalse(passes(""))
+        self.assertFalse(passes("rpm-4.14.2-1.x86_64\nrpm-4.14.2-1.i686\n"))
+        self.assertFalse(passes("yum-3.4.3-1.noarch\n"))
+        self.assertFalse(passes("rpm-4.14.2-1.x86_64\n", StatusCode.SEGFAULT))
+
+    def test_rpmdb_index_probes_follow_dbpath(self):
+        # type: () -> None
+        probes = self.rpmutil._rpmdb_index_probes()
+        self.assertIs(self.rpmutil._rpmdb_index_probes(), probes)
+        self.rpmutil.dbpath = "/some/other/rpmdb"
+        probes = self.rpmutil._rpmdb_index_probes()
+        self.assertEqual(probes["Basenames"]["cmd"][-1], "/some/other/rpmdb")
+
+    def test_any_line_is_rpm_or_yum(self):
+        # type: () -> None
+        for stdout, expected in [
+            ("", False),
+            ("rpm-build-4.14.2-1.x86_64\n", True),
+            ("dnf-4.2.7-1.noarch\nyum-3.4.3-1.noarch\n", True),
+            ("dnf-4.2.7-1.noarch\nrpm-build-4.14.2-1.x86_64\n", True),
+            ("dnf-4.2.7-1.noarch\npython3-rpm-4.14.2-1.x86_64\n", False),
+        ]:
+            proc = CompletedProcess(stdout=stdout)
+            self.assertEqual(
+                rpmutil._any_line_is_rpm_or_yum(proc, stdout.splitlines()), expected
+            )
+
+    def test_check_rpmdb_indexes_skips_missing(self):
+        # type: () -> None
+        (
+            self.mock_callable(os, "listdir")
+            .for_call(self.dbpath)
+            .to_return_value(["Basenames", "Packages"])
+            .and_assert_called_once()
+        )
+        (
+            self.mock_callable(rpmutil, "run_with_timeout")
+            .for_call(
+                [self.rpm_path, "-qf", self.rpm_path, "--dbpath", self.dbpath],
+                rpmutil.RPM_CHECK_TIMEOUT_SEC,
+                raise_on_nonzero=False,
+            )
+            .to_return_value(CompletedProcess(stdout="rpm-4.14.2-1.x86_64\n"))
+            .and_assert_called_once()
+        )
+        self.rpmutil.check_rpmdb_indexes()
+
+    def test_check_rpmdb_indexes_rebuilds_bad_index(self):
+        # type: () -> None
+        index_path = os.path.join(self.dbpath, "Basenames")
+        self.mock_callable(os, "listdir").to_return_value(["Basenames"])
+        (
+            self.mock_callable(rpmutil, "run_with_timeout")
+            .to_return_values(
+                [
+                    CompletedProcess(stdout=""),
+                    CompletedProcess(stderr="error: missing index Basenames\n"),
+                ]
+            )
+            .and_assert_called_twice()
+        )
+        self.mock_callable(os.path, "isfile").for_call(index_path).to_return_value(True)
+        (
+            self.mock_callable(os, "remove")
+            .for_call(index_path)
+            .to_return_value(None)
+            .and_assert_called_once()
+        )
+        self.rpmutil.check_rpmdb_indexes()
+
+    def test_check_rpmdb_indexes_rebuilds_only_bad_index(self):
+        # type: () -> None
+        self.mock_callable(os, "listdir").to_return_value(["Basenames", "Providename"])
+        (
+            self.mock_callable(rpmutil, "run_with_timeout")
+            .for_call(
+                [self.rpm_path, "-qf", self.rpm_path, "--dbpath", self.dbpath],
+                rpmutil.RPM_CHECK_TIMEOUT_SEC,
+                raise_on_nonzero=False,
+            )
+            .to_return_value(CompletedProcess(stdout="rpm-4.14.2-1.x86_64\n"))
+            .and_assert_called_once()
+        )
+        (
+            self.mock_callable(rpmutil, "run_with_timeout")
+            .for_call(
+                [
+                    self.rpm_path,
+                    "-q",
+                    "--whatprovides",
+                    "rpm",
+                    "--dbpath",
+                    self.dbpath,
+                ],
+                rpmutil.RPM_CHECK_TIMEOUT_SEC,
+                raise_on_nonzero=False,
+            )
+            .to_return_values(
+                [
+                    CompletedProcess(stdout=""),
+                    CompletedProcess(stderr="error: missing index Providename\n"),
+                ]
+            )
+            .and_assert_called_twice()
+        )
+        index_path = os.path.join(self.dbpath, "Providename")
+        self.mock_callable(os.path, "isfile").for_call(index_path).to_return_value(True)
+        (
+            self.mock_callable(os, "remove")
+            .for_call(index_path)
+            .to_return_value(None)
+            .and_assert_called_once()
+        )
+        self.rpmutil.check_rpmdb_indexes()
+
+    def test_check_rpmdb_indexes_probe_failure_needs_recovery(self):
+        # type: () -> None
+        self.mock_callable(os, "listdir").to_return_value(["Basenames", "Providename"])
+        (
+            self.mock_callable(rpmutil, "run_with_timeout")
+            .to_raise(DcRPMException)
+            .and_assert_called()
+        )
+        self.mock_callable(os, "remove").and_assert_not_called()
+        with self.assertRaises(DBNeedsRecovery):
+            self.rpmutil.check_rpmdb_indexes()
+
+    def test_check_rpmdb_indexes_rebuild_needs_recovery(self):
+        # type: () -> None
+        self.mock_callable(os, "listdir").to_return_value(["Basenames"])
+        (
+            self.mock_callable(rpmutil, "run_with_timeout")
+            .to_return_values(
+                [
+                    CompletedProcess(stdout=""),
+                    CompletedProcess(stderr="error: cannot open Packages database\n"),
+                ]
+            )
+            .and_assert_called_twice()
+        )
+        self.mock_callable(os.path, "isfile").to_return_value(False)
+        with self.assertRaises(DBNeedsRecovery):
+            self.rpmutil.check_rpmdb_indexes()
+
     def test_check_rpm_qa_raise_on_nonzero_rc(self):
         # type: () -> None
         (
@@ -254,6 +445,32 @@ class TestRPMUtil(testslide.TestCase):
         with self.assertRaises(DBNeedsRebuild):
             self.rpmutil.check_tables()
 
+    def test_check_tables_reuses_rpm_qa(self):
+        # type: () -> None
+        names = ["rpm{}".format(i) for i in range(rpmutil.MIN_ACCEPTABLE_PKG_COUNT)]
+        (
+            self.mock_callable(rpmutil, "run_with_timeout")
+            .for_call(
+                [self.rpm_path, "--dbpath", self.dbpath, "-qa", "--qf", "%{NAME}\\n"],
+                rpmutil.RPM_CHECK_TIMEOUT_SEC,
+            )
+            .to_return_value(CompletedProcess(stdout="\n".join(names) + "\n"))
+            .and_assert_called_once()
+        )
+        (
+            self.mock_callable(rpmutil, "run_with_timeout")
+            .for_call(
+                [self.rpm_path, "--dbpath", self.dbpath, "-q"] + sorted(names),
+                timeout=rpmutil.RPM_CHECK_TIMEOUT_SEC,
+                exception_to_raise=DBNeedsRebuild,
+            )
+            .to_return_value(CompletedProcess())
+            .and_assert_called_once()
+        )
+        self.mock_callable(rpmutil, "read_os_name").to_return_value("Linux")
+        self.rpmutil.check_rpm_qa()
+        self.rpmutil.check_tables()
+
     def test_check_tables_raises_on_uninstalled(self):
         # type: () -> None
         (
@@ -334,9 +551,93 @@ class TestRPMUtil(testslide.TestCase):
             .to_return_value(CompletedProcess(returncode=1))
             .and_assert_called_once()
         )
+        (
+            self.mock_callable(rpmutil, "run_with_timeout")
+            .for_call(
+                [self.verify_path, os.path.join(self.dbpath, "table3")],
+                rpmutil.VERIFY_TIMEOUT_SEC,
+                raise_on_nonzero=False,
+            )
+            .to_return_value(CompletedProcess())
+        )
         with self.assertRaises(DcRPMException):
             self.rpmutil.verify_tables()
 
+    def test_verify_tables_timeout(self):
+        # type: () -> None
+        (
+            self.mock_callable(rpmutil, "run_with_timeout")
+            .to_raise(DcRPMException())
+            .and_assert_called()
+        )
+        with self.assertRaises(DcRPMException):
+            self.rpmutil.verify_tables()
+
+    # db_stat
+    def test_db_stat_debug(self):
+        # type: () -> None
+        self.rpmutil.status_logger = logging.getLogger("test_db_stat")
+        self.rpmutil.status_logger.setLevel(logging.DEBUG)
+        (
+            self.mock_callable(rpmutil, "run_with_timeout")
+            .for_call(
+                [self.stat_path, "-CA", "-h", self.dbpath],
+                rpmutil.RPM_CHECK_TIMEOUT_SEC,
+                raise_on_nonzero=False,
+            )
+            .to_return_value(CompletedProcess(stdout="Default locking region"))
+            .and_assert_called_once()
+        )
+        self.rpmutil.db_stat()
+
+    def test_db_stat_skipped_without_debug(self):
+        # type: () -> None
+        self.rpmutil.status_logger = logging.getLogger("test_db_stat")
+        self.rpmutil.status_logger.setLevel(logging.INFO)
+        self.mock_callable(rpmutil, "run_with_timeout").and_assert_not_called()
+        self.rpmutil.db_stat()
+
+    # get_db_backend
+    def test_get_macros(self):
+        # type: () -> None
+        showrc = "\n".join(
+            [
+                "ARCHITECTURE AND OS:",
+                "build arch            : x86_64",
+                "========================",
+                "-14: __7zip\t/usr/bin/7za",
+                "-13: _build_id_links\tcompat",
+                "-14: _db_backend\tbdb",
+                "-14: __spec_install_pre\t%{___build_pre}",
+                "-14: _some_multiline_macro\t",
+                "  first line",
+                "-13: _vendor\tredhat",
+                "",
+            ]
+        )
+        (
+            self.mock_callable(rpmutil, "run_with_timeout")
+            .for_call(
+                [self.rpm_path, "--dbpath", self.dbpath, "--showrc"],
+                timeout=rpmutil.RPM_CHECK_TIMEOUT_SEC,
+            )
+            .to_return_value(CompletedProcess(stdout=showrc))
+            .and_assert_called_once()
+        )
+        self.assertEqual(
+            self.rpmutil._get_macros(),
+            {"_build_id_links": "compat", "_db_backend": "bdb", "_vendor": "redhat"},
+        )
+
+    def test_get_db_backend_default(self):
+        # type: () -> None
+        (
+            self.mock_callable(rpmutil, "run_with_timeout")
+            .to_return_value(CompletedProcess(stdout="-13: _vendor\tredhat\n"))
+            .and_assert_called_once()
+        )
+        self.assertEqual(self.rpmutil.get_db_backend(), "bdb")
+
     # clean_yum_transactions
     def test_clean_yum_transactions_success(self):
         # type: () -> None
@@ -376,6 +677,9 @@ class TestRPMUtil(testslide.TestCase):
         young_bin_rpm = make_mock_process(
             333, cmdline="/bin/rpm -q bar-788.x86_64", create_time=9000
         )
+        old_rpmbuild = make_mock_process(
+            444, cmdline="/usr/bin/rpmbuild -q -ba foo.spec", create_time=1000
+        )
 
         test_procs = [
             young_rpm,
@@ -386,36 +690,29 @@ class TestRPMUtil(testslide.TestCase):
             old_usr_bin_rpm_wait_throw,
             old_usr_bin_rpm_cmdline_throw,
             young_bin_rpm,
+            old_rpmbuild,
         ]  # type: t.List[typing.Any]
         (
             self.mock_callable(psutil, "process_iter")
+            .for_call(attrs=["cmdline", "create_time"])
             .to_yield_values(test_procs)
             .and_assert_called_once()
         )
         self.mock_callable(time, "time").to_return_value(10000)
+        self.mock_callable(pidutil, "wait_pidfd").to_return_value(None)
 
         self.rpmutil.kill_spinning_rpm_query_processes()
 
-        assert_called_like(young_rpm, create_time=True, send_signal=False, wait=False)
-        assert_called_like(
-            young_non_rpm, create_time=False, send_signal=False, wait=False
-        )
-        assert_called_like(
-            young_non_rpm2, create_time=False, send_signal=False, wait=False
-        )
-        assert_called_like(old_bin_rpm, create_time=True, send_signal=True, wait=True)
-        assert_called_like(
-            old_usr_bin_rpm, create_time=True, send_signal=True, wait=True
-        )
-        assert_called_like(
-            old_usr_bin_rpm_wait_throw, create_time=True, send_signal=True, wait=True
-        )
+        assert_called_like(young_rpm, send_signal=False, wait=False)
+        assert_called_like(young_non_rpm, send_signal=False, wait=False)
+        assert_called_like(young_non_rpm2, send_signal=False, wait=False)
+        assert_called_like(old_bin_rpm, send_signal=True, wait=True)
+        assert_called_like(old_usr_bin_rpm, send_signal=True, wait=True)
+        assert_called_like(old_usr_bin_rpm_wait_throw, send_signal=True, wait=True)
         assert_called_like(
             old_usr_bin_rpm_cmdline_throw,
-            create_time=False,
             send_signal=False,
             wait=False,
         )
-        assert_called_like(
-            young_bin_rpm, create_time=True, send_signal=False, wait=False
-        )
+        assert_called_like(young_bin_rpm, send_signal=False, wait=False)
+        assert_called_like(old_rpmbuild, send_signal=False, wait=False)
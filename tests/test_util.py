@@ -11,22 +11,26 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import math
+import os
 import signal
 import subprocess
 import time
 import typing as t  # noqa
+import unittest
 
 import testslide
+from dcrpm import util
 from dcrpm.util import (
     DcRPMException,
     TimeoutExpired,
     alarm_handler,
     call_with_timeout,
     kindly_end,
+    memoize,
     run_with_timeout,
+    wait_pidfd,
 )
 
-
 try:
     from unittest.mock import Mock
 except ImportError:
@@ -49,17 +53,32 @@ def make_mock_popen(
     # set PID because this is used by pytest's logging.py
     mock_popen_obj = Mock(pid=42)
     config = {"poll.return_value": returncode}  # type: t.Dict[str, t.Any]
+    if hasattr(subprocess, "TimeoutExpired"):
+        timeout_expired = subprocess.TimeoutExpired("cmd", 5)  # type: Exception
+    else:
+        timeout_expired = TimeoutExpired()
     if communicate_raise:
-        config["communicate.side_effect"] = TimeoutExpired()
+        config["communicate.side_effect"] = timeout_expired
     else:
         config["communicate.return_value"] = (stdout, stderr)
     if terminate_raise:
-        config["terminate.side_effect"] = TimeoutExpired()
+        # The process ignores SIGTERM, so waiting on it times out
+        config["wait.side_effect"] = timeout_expired
     mock_popen_obj.configure_mock(**config)
     return mock_popen_obj
 
 
 class TestUtil(testslide.TestCase):
+
+    def setUp(self):
+        # type: () -> None
+        super(TestUtil, self).setUp()
+        # Mock Popens have a made-up pid, don't go looking for a real one.
+        self.mock_callable(util, "wait_pidfd").to_return_value(None)
+        self.mock_callable(
+            util, "_spawn_close_fds", allow_private=True
+        ).to_return_value(False)
+
     # call_with_timeout
     def test_call_with_timeout_success(self):
         # type: () -> None
@@ -71,9 +90,9 @@ class TestUtil(testslide.TestCase):
         )
         for val in [2, 0]:
             (
-                self.mock_callable(signal, "alarm")
-                .for_call(val)
-                .to_return_value(None)
+                self.mock_callable(signal, "setitimer")
+                .for_call(signal.ITIMER_REAL, val)
+                .to_return_value((0.0, 0.0))
                 .and_assert_called_once()
             )
         result = call_with_timeout(math.floor, 2, args=[2.5])
@@ -81,12 +100,51 @@ class TestUtil(testslide.TestCase):
 
     def test_call_with_timeout_real_raises(self):
         # type: () -> None
+        start = time.time()
         with self.assertRaises(TimeoutExpired):
-            call_with_timeout(time.sleep, 1, args=[2])
+            call_with_timeout(time.sleep, 0.1, args=[2])
+        self.assertLess(time.time() - start, 1)
 
-    # run_with_timeout
-    def test_run_with_timeout_success(self):
+    # memoize
+    def test_memoize(self):
         # type: () -> None
+        calls = []  # type: t.List[str]
+
+        @memoize
+        def double(x):
+            # type: (str) -> str
+            calls.append(x)
+            return x * 2
+
+        self.assertEqual(double("a"), "aa")
+        self.assertEqual(double("a"), "aa")
+        self.assertEqual(double("b"), "bb")
+        self.assertEqual(calls, ["a", "b"])
+        self.assertEqual(double.__name__, "double")
+
+    def test_memoize_without_lru_cache(self):
+        # type: () -> None
+        # patch_attribute won't replace a callable, so swap it by hand
+        self.addCleanup(setattr, util, "lru_cache", util.lru_cache)
+        util.lru_cache = None
+        calls = []  # type: t.List[t.Tuple[str, str]]
+
+        @memoize
+        def join(x, sep=""):
+            # type: (str, str) -> str
+            calls.append((x, sep))
+            return sep.join(x)
+
+        self.assertEqual(join("ab"), "ab")
+        self.assertEqual(join("ab"), "ab")
+        self.assertEqual(join("ab", sep="-"), "a-b")
+        self.assertEqual(join("ab", sep="-"), "a-b")
+        self.assertEqual(calls, [("ab", ""), ("ab", "-")])
+        self.assertEqual(join.__name__, "join")
+
+    # run_with_timeout
+    def _expect_popen(self, mock_popen):
+        # type: (Mock) -> None
         (
             self.mock_constructor(subprocess, "Popen")
             .for_call(
@@ -94,27 +152,26 @@ class TestUtil(testslide.TestCase):
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 universal_newlines=True,
+                close_fds=False,
+                bufsize=-1,
             )
-            .to_return_value(make_mock_popen())
+            .to_return_value(mock_popen)
             .and_assert_called_once()
         )
+
+    def test_run_with_timeout_success(self):
+        # type: () -> None
+        mock_popen = make_mock_popen()
+        self.mock_callable(signal, "setitimer").and_assert_not_called()
+        self._expect_popen(mock_popen)
         result = run_with_timeout(["/bin/true"], 5)
         self.assertEqual(result.returncode, 0)
+        mock_popen.communicate.assert_called_once_with(timeout=5)
 
     def test_run_with_timeout_timeout(self):
         # type: () -> None
         mock_popen = make_mock_popen(communicate_raise=True)
-        (
-            self.mock_constructor(subprocess, "Popen")
-            .for_call(
-                ["/bin/true"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-            )
-            .to_return_value(mock_popen)
-            .and_assert_called_once()
-        )
+        self._expect_popen(mock_popen)
         with self.assertRaises(DcRPMException):
             run_with_timeout(["/bin/true"], 5)
         mock_popen.kill.assert_not_called()
@@ -122,17 +179,7 @@ class TestUtil(testslide.TestCase):
     def test_run_with_timeout_terminates_on_timeout(self):
         # type: () -> None
         mock_popen = make_mock_popen(communicate_raise=True)
-        (
-            self.mock_constructor(subprocess, "Popen")
-            .for_call(
-                ["/bin/true"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-            )
-            .to_return_value(mock_popen)
-            .and_assert_called_once()
-        )
+        self._expect_popen(mock_popen)
         with self.assertRaises(DcRPMException):
             run_with_timeout(["/bin/true"], 5)
         mock_popen.terminate.assert_called()
@@ -141,17 +188,7 @@ class TestUtil(testslide.TestCase):
     def test_run_with_timeout_kills_on_terminate_timeout(self):
         # type: () -> None
         mock_popen = make_mock_popen(communicate_raise=True, terminate_raise=True)
-        (
-            self.mock_constructor(subprocess, "Popen")
-            .for_call(
-                ["/bin/true"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-            )
-            .to_return_value(mock_popen)
-            .and_assert_called_once()
-        )
+        self._expect_popen(mock_popen)
         with self.assertRaises(DcRPMException):
             run_with_timeout(["/bin/true"], 5)
         mock_popen.terminate.assert_called()
@@ -159,50 +196,20 @@ class TestUtil(testslide.TestCase):
 
     def test_run_with_timeout_raise_on_nonzero(self):
         # type: () -> None
-        (
-            self.mock_constructor(subprocess, "Popen")
-            .for_call(
-                ["/bin/true"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-            )
-            .to_return_value(make_mock_popen(returncode=1))
-            .and_assert_called_once()
-        )
+        self._expect_popen(make_mock_popen(returncode=1))
         with self.assertRaises(DcRPMException):
             run_with_timeout(["/bin/true"], 5)
 
     def test_run_with_timeout_no_raise_on_nonzero(self):
         # type: () -> None
-        (
-            self.mock_constructor(subprocess, "Popen")
-            .for_call(
-                ["/bin/true"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-            )
-            .to_return_value(make_mock_popen(returncode=1))
-            .and_assert_called_once()
-        )
+        self._expect_popen(make_mock_popen(returncode=1))
         result = run_with_timeout(["/bin/true"], 5, raise_on_nonzero=False)
         self.assertEqual(result.returncode, 1)
 
     def test_run_with_timeout_no_raise_on_timeout(self):
         # type: () -> None
         mock_popen = make_mock_popen(returncode=1, communicate_raise=True)
-        (
-            self.mock_constructor(subprocess, "Popen")
-            .for_call(
-                ["/bin/true"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-            )
-            .to_return_value(mock_popen)
-            .and_assert_called_once()
-        )
+        self._expect_popen(mock_popen)
         result = run_with_timeout(["/bin/true"], 5, raise_on_timeout=False)
         self.assertNotEqual(result.returncode, 1)
         self.assertEqual(result.stdout, "")
@@ -221,3 +228,57 @@ class TestUtil(testslide.TestCase):
         kindly_end(mock_popen)
         mock_popen.terminate.assert_called()
         mock_popen.kill.assert_called()
+
+    def test_kindly_end_waits_on_pidfd(self):
+        # type: () -> None
+        mock_popen = make_mock_popen()
+        (
+            self.mock_callable(util, "wait_pidfd")
+            .for_call(42, 5)
+            .to_return_value(True)
+            .and_assert_called_once()
+        )
+        kindly_end(mock_popen, timeout=5)
+        mock_popen.wait.assert_called_once_with(timeout=0)
+
+
+class TestWaitPidfd(testslide.TestCase):
+    @unittest.skipUnless(hasattr(os, "pidfd_open"), "requires os.pidfd_open")
+    def test_wait_pidfd_exited(self):
+        # type: () -> None
+        child = subprocess.Popen(["sleep", "30"])
+        child.kill()
+        try:
+            self.assertTrue(wait_pidfd(child.pid, 5))
+        finally:
+            child.wait()
+
+    @unittest.skipUnless(hasattr(os, "pidfd_open"), "requires os.pidfd_open")
+    def test_wait_pidfd_timeout(self):
+        # type: () -> None
+        child = subprocess.Popen(["sleep", "30"])
+        try:
+            self.assertFalse(wait_pidfd(child.pid, 0.1))
+        finally:
+            child.kill()
+            child.wait()
+
+
+class TestSpawnCloseFds(testslide.TestCase):
+    @unittest.skipUnless(hasattr(os, "set_inheritable"), "requires PEP 446")
+    def test_spawn_close_fds_marks_inherited_fds(self):
+        # type: () -> None
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        self.addCleanup(os.close, w)
+        os.set_inheritable(w, True)
+        # pyre-ignore[16]: memoize wraps with functools.wraps
+        self.assertFalse(util._spawn_close_fds.__wrapped__())
+        self.assertFalse(os.get_inheritable(w))
+
+    @unittest.skipUnless(hasattr(os, "set_inheritable"), "requires PEP 446")
+    def test_spawn_close_fds_falls_back_to_closing(self):
+        # type: () -> None
+        self.mock_callable(os, "listdir").for_call("/dev/fd").to_raise(OSError)
+        # pyre-ignore[16]: memoize wraps with functools.wraps
+        self.assertTrue(util._spawn_close_fds.__wrapped__())
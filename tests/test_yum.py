@@ -14,6 +14,7 @@ import time
 
 import testslide
 from dcrpm import pidutil, yum
+from dcrpm.util import DcRPMException
 from tests.mock_process import make_mock_process
 
 
@@ -24,6 +25,29 @@ class TestYum(testslide.TestCase):
         self.yum = yum.Yum()  # type: yum.Yum
         self.yum.yum = "fakeyum"
 
+    # __init__
+    def test_init_uses_found_yum(self):
+        # type: () -> None
+        (
+            self.mock_callable(yum, "_find_yum", allow_private=True)
+            .to_return_value(yum.DNF_CMD_NAME)
+            .and_assert_called_once()
+        )
+        self.assertEqual(yum.Yum().yum, yum.DNF_CMD_NAME)
+
+    def test_init_no_yum_linux(self):
+        # type: () -> None
+        self.mock_callable(yum, "_find_yum", allow_private=True).to_return_value(None)
+        self.mock_callable(yum, "read_os_name").to_return_value("Linux")
+        with self.assertRaises(DcRPMException):
+            yum.Yum()
+
+    def test_init_no_yum_darwin(self):
+        # type: () -> None
+        self.mock_callable(yum, "_find_yum", allow_private=True).to_return_value(None)
+        self.mock_callable(yum, "read_os_name").to_return_value("Darwin")
+        self.assertEqual(yum.Yum().yum, yum.YUM_CMD_NAME)
+
     # check_stuck
     def test_check_stuck_filenotfound(self):
         # type: () -> None